@@ -0,0 +1,195 @@
+import struct, zlib
+import numpy as np
+
+# Write the logo being drawn as an animation. Frames are written as they come in, and only the rectangle that changed since the
+# previous frame is stored, so memory use doesn't depend on the length of the animation. Pillow collects all frames of an
+# animation before it writes them, so the GIF and APNG files are written here.
+
+class Writer:
+    def __init__(self, f, pal, shape=(200, 320)):
+        # pal is the flat RGBA palette of kick2svg.Convert
+        self.f = f
+        self.pal = bytes(np.array(pal, dtype=np.uint8).reshape(-1, 4)[:, :3].ravel())
+        self.shape = shape
+        self.prev = np.zeros(shape, dtype=np.uint8)
+        self.count = 0
+        # the last frame is held back, a following frame without changes only makes it last longer
+        self.pending = None
+        self.start()
+
+    def add(self, fb, delay):
+        # a frame of pen indices that is shown for delay milliseconds
+        changed = fb != self.prev
+        if self.pending != None and not changed.any():
+            self.pending[1] += delay
+            return
+        if self.pending == None:
+            x0, y0, x1, y1 = 0, 0, self.shape[1], self.shape[0]
+        else:
+            ys, xs = np.nonzero(changed)
+            x0, y0, x1, y1 = int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1
+        np.copyto(self.prev, fb)
+        self.flush()
+        self.pending = [(x0, y0), delay, fb[y0:y1, x0:x1].copy()]
+
+    def flush(self):
+        if self.pending != None:
+            self.frame(*self.pending)
+            self.count += 1
+            self.pending = None
+
+    def close(self):
+        self.flush()
+        self.finish()
+
+def lzw(pixels, min_size):
+    # GIF flavoured LZW: variable code size from min_size + 1 up to 12 bits, packed least significant bit first
+    clear, end = 1 << min_size, (1 << min_size) + 1
+    out = bytearray()
+    acc = bits = 0
+
+    def emit(code):
+        nonlocal acc, bits
+        acc |= code << bits
+        bits += size
+        while bits >= 8:
+            out.append(acc & 0xFF)
+            acc >>= 8
+            bits -= 8
+
+    size = min_size + 1
+    table = {}
+    next_code = end + 1
+    emit(clear)
+    data = pixels.tobytes()
+    prefix = data[0]
+    for c in data[1:]:
+        code = table.get((prefix, c))
+        if code != None:
+            prefix = code
+            continue
+        emit(prefix)
+        if next_code == 4096:
+            # table full, start over
+            emit(clear)
+            table = {}
+            next_code = end + 1
+            size = min_size + 1
+        else:
+            table[(prefix, c)] = next_code
+            if next_code == 1 << size:
+                size += 1
+            next_code += 1
+        prefix = c
+    emit(prefix)
+    emit(end)
+    if bits > 0:
+        out.append(acc & 0xFF)
+    return bytes(out)
+
+class GifWriter(Writer):
+    def start(self):
+        h, w = self.shape
+        # logical screen with a global colour table of 4 entries, and loop forever
+        self.f.write(b"GIF89a" + struct.pack("<HHBBB", w, h, 0x91, 0, 0) + self.pal)
+        self.f.write(b"\x21\xFF\x0BNETSCAPE2.0\x03\x01\x00\x00\x00")
+
+    def frame(self, pos, delay, pixels):
+        # graphic control extension: leave the frame in place, the delay is in 1/100 s. A delay beyond what fits into its
+        # 16 bits is continued by single pixel frames that don't change anything.
+        delay = int(round(delay / 10))
+        self.image(pos, min(delay, 0xFFFF), pixels)
+        delay -= 0xFFFF
+        while delay > 0:
+            self.image(pos, min(delay, 0xFFFF), pixels[:1, :1])
+            delay -= 0xFFFF
+
+    def image(self, pos, delay, pixels):
+        h, w = pixels.shape
+        self.f.write(b"\x21\xF9\x04\x04" + struct.pack("<H", delay) + b"\x00\x00")
+        self.f.write(b"\x2C" + struct.pack("<HHHHB", pos[0], pos[1], w, h, 0))
+        data = lzw(pixels, 2)
+        self.f.write(b"\x02")
+        for i in range(0, len(data), 255):
+            block = data[i:i+255]
+            self.f.write(bytes([len(block)]) + block)
+        self.f.write(b"\x00")
+
+    def finish(self):
+        self.f.write(b"\x3B")
+
+class ApngWriter(Writer):
+    def chunk(self, kind, data):
+        self.f.write(struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data)))
+
+    def start(self):
+        if not self.f.seekable():
+            raise ValueError("APNG output has to be a seekable file, the number of frames is written at the end")
+        h, w = self.shape
+        self.f.write(b"\x89PNG\r\n\x1a\n")
+        self.chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, 8, 3, 0, 0, 0))
+        self.chunk(b"PLTE", self.pal)
+        # the number of frames is only known at the end, the animation control chunk is filled in by finish()
+        self.actl = self.f.tell()
+        self.chunk(b"acTL", struct.pack(">II", 0, 0))
+        self.sequence = 0
+
+    def frame(self, pos, delay, pixels):
+        h, w = pixels.shape
+        # the delay is a 16 bit fraction, long delays are stored in coarser units
+        den = 1000
+        while round(delay * den / 1000) > 0xFFFF and den > 1:
+            den //= 10
+        num = min(int(round(delay * den / 1000)), 0xFFFF)
+        self.chunk(b"fcTL", struct.pack(">IIIIIHHBB", self.sequence, w, h, pos[0], pos[1], num, den, 0, 0))
+        self.sequence += 1
+        # every row starts with filter type 0
+        rows = np.zeros((h, w + 1), dtype=np.uint8)
+        rows[:, 1:] = pixels
+        data = zlib.compress(rows.tobytes(), 9)
+        if self.count == 0:
+            # the first frame is the default image
+            self.chunk(b"IDAT", data)
+        else:
+            self.chunk(b"fdAT", struct.pack(">I", self.sequence) + data)
+            self.sequence += 1
+
+    def finish(self):
+        self.chunk(b"IEND", b"")
+        end = self.f.tell()
+        self.f.seek(self.actl)
+        self.chunk(b"acTL", struct.pack(">II", self.count, 0))
+        self.f.seek(end)
+
+class RawWriter(Writer):
+    # 320x200 RGB frames at a fixed rate, for example for "ffmpeg -f rawvideo -pix_fmt rgb24 -s 320x200 -r 25 -i logo.rgb".
+    # Every frame is written in full, a frame that lasts longer is repeated.
+    def __init__(self, f, pal, shape=(200, 320), frame_time=40):
+        self.frame_time = frame_time
+        Writer.__init__(self, f, pal, shape)
+
+    def start(self):
+        self.rgb = np.frombuffer(self.pal, dtype=np.uint8).reshape(-1, 3)
+
+    def add(self, fb, delay):
+        data = self.rgb[fb].tobytes()
+        for i in range(max(1, int(round(delay / self.frame_time)))):
+            self.f.write(data)
+            self.count += 1
+
+    def finish(self):
+        pass
+
+WRITERS = {"gif":GifWriter, "apng":ApngWriter, "raw":RawWriter}
+
+def animate(frames, f, pal, kind="gif", delay=40, hold=2000):
+    # write the frames of kick2svg.Convert.replay() to the file object f, the last frame is shown for hold milliseconds.
+    # Returns the number of frames written.
+    writer = RawWriter(f, pal, frame_time=delay) if kind == "raw" else WRITERS[kind](f, pal)
+    fb = None
+    for fb in frames:
+        writer.add(fb, delay)
+    if fb is not None and hold > delay:
+        writer.add(fb, hold - delay)
+    writer.close()
+    return writer.count
@@ -0,0 +1,148 @@
+import argparse, base64, io, json, os, platform, random, shutil, statistics, struct, sys, tempfile, time
+
+# Benchmarks for the hot paths of both scripts. Everything runs on generated fixtures, a synthetic ROM with a logo at the 1.3
+# offsets and SVGs of increasing complexity, so no Kickstart image is needed.
+# Results are written as JSON and can be compared against a stored baseline.
+
+# (shapes, path nodes, bitmaps) per level
+LEVELS = {
+    "small": (4, 50, 0),
+    "medium": (16, 500, 1),
+    "large": (48, 4000, 3),
+}
+
+def make_rom(path, seed=1):
+    # 256K of noise with a Kickstart 1.3 header, the default palette, a small logo and a valid checksum
+    import svg2kick, rom
+    rng = random.Random(seed)
+    data = bytearray(rng.getrandbits(8) for _ in range(256*1024))
+    data[0:4] = b"\x11\x11\x4e\xf9"
+    struct.pack_into(">HH", data, 12, 34, 5)
+    data[0x2872A:0x2872A+8] = rom.DEFAULT_PALETTE
+    vectors = [0xFF,1, 10,10, 100,10, 100,80, 10,80, 10,10, 0xFE,2, 50,50, 0xFF,3, 120,20, 180,90, 0xFF,0xFF]
+    data[0x289d0:0x289d0+len(vectors)] = bytes(vectors)
+    images = [0,1, 2,4, 20,20] + [0xF0,0x0F, 0xAA,0x55]*4 + [0xFF,0xFF]
+    data[0x28B6C:0x28B6C+len(images)] = bytes(images)
+    struct.pack_into(">I", data, len(data) - 24, 0)
+    struct.pack_into(">I", data, len(data) - 24, 0xFFFFFFFF - svg2kick.rom_checksum(data))
+    with open(path, "wb") as f:
+        f.write(data)
+
+def make_svg(path, shapes, nodes, bitmaps, seed=1):
+    from PIL import Image
+    rng = random.Random(seed)
+    colours = ["#ff0000", "#0000ff", "#000000"]
+    out = ['<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" width="320" height="200">']
+    for i in range(shapes):
+        x, y = rng.randint(75, 280), rng.randint(45, 175)
+        out.append('<rect x="%i" y="%i" width="%i" height="%i" style="fill:%s;stroke:#000000"/>' % (x, y, rng.randint(3, 40), rng.randint(3, 25), rng.choice(colours)))
+    points = ["%.2f,%.2f" % (rng.uniform(80, 300), rng.uniform(50, 190)) for i in range(nodes)]
+    out.append('<path d="M %s L %s" style="fill:none;stroke:#000000"/>' % (points[0], " ".join(points[1:])))
+    for i in range(bitmaps):
+        image = Image.new("RGBA", (24, 12), (0, 0, 0, 0))
+        for x in range(24):
+            for y in range(12):
+                if rng.random() < 0.4:
+                    image.putpixel((x, y), (255, 0, 0, 255))
+        with io.BytesIO() as output:
+            image.save(output, format="PNG")
+            uri = "data:image/png;base64," + base64.b64encode(output.getvalue()).decode("utf-8")
+        out.append('<image x="%i" y="%i" width="24" height="12" xlink:href="%s"/>' % (rng.randint(80, 280), rng.randint(50, 180), uri))
+    out.append('</svg>')
+    with open(path, "w") as f:
+        f.write("\n".join(out))
+
+def measure(fn, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {"median": statistics.median(times), "min": min(times), "runs": repeat}
+
+def run(workdir, repeat):
+    # the fixtures are written to workdir
+    import kick2svg, svg2kick, rom
+    results = {}
+    kick = os.path.join(workdir, "kick.bin")
+    make_rom(kick)
+    data = rom.open_rom(kick)
+
+    results["rom.locate"] = measure(lambda: rom.locate(data), repeat)
+
+    convert = kick2svg.Convert()
+    results["kick2svg.load"] = measure(lambda: convert.load(kick), repeat)
+    results["kick2svg.save_png"] = measure(lambda: convert.save_png(os.path.join(workdir, "logo.png")), repeat)
+    results["kick2svg.save_svg"] = measure(lambda: convert.save_svg(os.path.join(workdir, "logo.svg")), repeat)
+
+    for level, (shapes, nodes, bitmaps) in LEVELS.items():
+        svg = os.path.join(workdir, "%s.svg" % level)
+        make_svg(svg, shapes, nodes, bitmaps)
+
+        results["svg2kick.process/%s" % level] = measure(lambda: svg2kick.Convert().process(svg), repeat)
+
+        # the fill search on its own: the same rectangles on a fresh canvas
+        rng = random.Random(level)
+        rects = [(rng.randint(75, 280), rng.randint(45, 175), rng.randint(3, 40), rng.randint(3, 25)) for i in range(shapes)]
+        def fill_rects():
+            c = svg2kick.Convert()
+            c.fillColor = (240, 0, 0)
+            for x, y, w, h in rects:
+                c.poly([(x,y), (x+w,y), (x+w,y+h), (x,y+h), (x,y)])
+        results["svg2kick.poly/%s" % level] = measure(fill_rects, repeat)
+
+        patcher = svg2kick.Convert()
+        patcher.process(svg)
+        results["svg2kick.patch/%s" % level] = measure(lambda: patcher.patch(kick), repeat)
+        results["svg2kick.patch-full/%s" % level] = measure(lambda: patcher.patch(kick, "full"), repeat)
+    return results
+
+def compare(results, baseline, threshold):
+    # names of the benchmarks that got slower than threshold times the baseline
+    slower = []
+    for name, result in sorted(results.items()):
+        base = baseline.get("results", {}).get(name)
+        if base == None:
+            print("%-32s %9.2f ms   (new)" % (name, result["median"]*1000))
+            continue
+        ratio = result["median"] / base["median"] if base["median"] > 0 else 1
+        flag = ""
+        if ratio > threshold:
+            slower.append(name)
+            flag = "  REGRESSION"
+        print("%-32s %9.2f ms  %9.2f ms  x%.2f%s" % (name, result["median"]*1000, base["median"]*1000, ratio, flag))
+    return slower
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the boot logo tools on synthetic fixtures')
+    parser.add_argument('--out', type=str, default='bench.json', help='write the results to this JSON file')
+    parser.add_argument('--baseline', type=str, help='compare against the results in this JSON file')
+    parser.add_argument('--threshold', type=float, default=1.25, help='fail if a benchmark is this many times slower than the baseline')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per benchmark, the median is reported')
+
+    args = parser.parse_args()
+
+    # keep the fixtures and their layout index out of the user's cache, the index is read when rom is first imported
+    workdir = tempfile.mkdtemp(prefix="bootlogo-bench-")
+    os.environ["AMIGABOOTLOGO_INDEX"] = os.path.join(workdir, "index.json")
+    try:
+        results = run(workdir, args.repeat)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    report = {"python": platform.python_version(), "platform": platform.platform(), "results": results}
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+
+    if args.baseline != None:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        slower = compare(results, baseline, args.threshold)
+        if len(slower) > 0:
+            print("%i benchmarks slower than x%.2f of the baseline" % (len(slower), args.threshold))
+            sys.exit(1)
+    else:
+        for name, result in sorted(results.items()):
+            print("%-32s %9.2f ms" % (name, result["median"]*1000))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import io, argparse, functools, threading
+import xml.etree.ElementTree as ET
+import kick2svg, svg2kick
+
+# Library interface to both tools: ROMs and SVGs are passed as bytes or file-like objects instead of paths, and the results are
+# returned instead of written. Pillow is only imported when an image is actually decoded or encoded.
+#
+#   import bootlogo
+#   png = bootlogo.extract_png(open("kick.bin", "rb"))
+#   patched = bootlogo.patch(rom_bytes, svg_bytes)
+#
+# "python bootlogo.py kick.bin" runs a small HTTP server on localhost that keeps the ROM and the converted SVGs in memory.
+
+def read(src):
+    # bytes of a bytes-like or file-like object
+    if hasattr(src, "read"):
+        return src.read()
+    return bytes(src)
+
+def extract(kick):
+    # the boot logo of a ROM image as a loaded kick2svg.Convert
+    convert = kick2svg.Convert()
+    convert.load_data(read(kick))
+    return convert
+
+def extract_png(kick):
+    with io.BytesIO() as output:
+        extract(kick).image().save(output, format="PNG")
+        return output.getvalue()
+
+def extract_svg(kick):
+    # the logo as an SVG element tree, ET.tostring() turns it into a document
+    return extract(kick).svg()
+
+def convert(svg, optimize=True, remote=False):
+    # an SVG as a processed svg2kick.Convert, ready to patch. Images are only read from data: URIs, unless remote is set,
+    # then they may also be loaded from files and URLs.
+    result = svg2kick.Convert()
+    result.remote = remote
+    result.process(io.BytesIO(read(svg)), optimize)
+    return result
+
+def patch(kick, svg, checksum="incremental", optimize=True):
+    # the ROM image with the logo of the SVG, svg may also be a Convert returned by convert()
+    if not isinstance(svg, svg2kick.Convert):
+        svg = convert(svg, optimize)
+    svg.patch_data(read(kick), checksum)
+    return bytes(svg.output())
+
+def preview_png(kick, svg, optimize=True):
+    # what the Kickstart will draw after patching
+    return extract_png(patch(kick, svg, "incremental", optimize))
+
+# The server keeps the ROM in memory, and the last converted SVGs by their contents. Conversions are run one at a time, numpy
+# releases the GIL too rarely for parallel conversions to be worth it. Images in posted SVGs are only read from data: URIs, so
+# the server never reads local files or fetches URLs, and a conversion never waits for I/O while holding the lock.
+
+class Service:
+    def __init__(self, kick):
+        self.data = read(kick)
+        self.lock = threading.Lock()
+        self.converted = functools.lru_cache(maxsize=32)(convert)
+
+    def patch(self, svg):
+        with self.lock:
+            return patch(self.data, self.converted(svg))
+
+    def handle(self, path, body):
+        # (content type, response) for a request
+        if path == "/preview":
+            return "image/png", extract_png(self.patch(body))
+        if path == "/patch":
+            return "application/octet-stream", self.patch(body)
+        if path == "/png":
+            return "image/png", extract_png(body)
+        if path == "/svg":
+            return "image/svg+xml", ET.tostring(extract_svg(body), encoding="utf-8", xml_declaration=True)
+        return None
+
+def serve(service, host="127.0.0.1", port=8642):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                result = service.handle(self.path, body)
+            except Exception as e:
+                self.send_error(400, "%s: %s" % (type(e).__name__, e))
+                return
+            if result == None:
+                self.send_error(404)
+                return
+            content_type, data = result
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    print("serving on http://%s:%i" % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve boot logo previews and patched ROM images over HTTP')
+    parser.add_argument('kick', type=str, help='Kickstart ROM image to patch')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8642, help='port to listen on')
+
+    args = parser.parse_args()
+    with open(args.kick, "rb") as f:
+        service = Service(f)
+    serve(service, args.host, args.port)
+
+if __name__ == "__main__":
+    main()
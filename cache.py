@@ -0,0 +1,75 @@
+import functools, hashlib, json, os
+import rom
+
+# Converted logos on disk, so an SVG that was converted before is patched without rendering it again.
+# Entries are keyed by the hash of the SVG, of the conversion options and of the converter sources, so editing the converter
+# invalidates them. Every entry is a small JSON file that is written atomically, so several processes can share the cache.
+# Reading an entry touches it, and the least recently used entries are removed once the cache grows beyond MAX_SIZE.
+
+DIR = os.environ.get("AMIGABOOTLOGO_CACHE", os.path.join(os.path.dirname(os.path.abspath(rom.INDEX)), "logos"))
+MAX_SIZE = int(os.environ.get("AMIGABOOTLOGO_CACHE_SIZE", 16*1024*1024))
+
+@functools.lru_cache(maxsize=None)
+def version():
+    # hash of the sources the conversion depends on
+    h = hashlib.sha1()
+    for name in ("svg2kick.py", "kick2svg.py", "raster.py"):
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name), "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def key(svg, *options):
+    # svg is a path or a file object, which is read in chunks and rewound afterwards
+    h = hashlib.sha1(version().encode("utf-8"))
+    h.update(repr(options).encode("utf-8"))
+    if hasattr(svg, "read"):
+        start = svg.tell()
+        for chunk in iter(lambda: svg.read(1 << 16), b""):
+            h.update(chunk)
+        svg.seek(start)
+    else:
+        with open(svg, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 16), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+def get(key):
+    # the stored entry, or None
+    path = os.path.join(DIR, key + ".json")
+    try:
+        with open(path, "r") as f:
+            entry = json.load(f)
+        os.utime(path)
+    except (OSError, ValueError):
+        return None
+    return entry
+
+def put(key, entry):
+    try:
+        os.makedirs(DIR, exist_ok=True)
+        rom.write_atomic(os.path.join(DIR, key + ".json"), json.dumps(entry).encode("utf-8"))
+        evict()
+    except OSError:
+        pass
+
+def evict(max_size=None):
+    # remove the least recently used entries until the cache fits. Another process may be evicting at the same time,
+    # so entries that are already gone are skipped.
+    max_size = MAX_SIZE if max_size == None else max_size
+    entries = []
+    for e in os.scandir(DIR):
+        if e.name.endswith(".json") and not e.name.startswith("."):
+            try:
+                st = e.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, e.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= size
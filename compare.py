@@ -0,0 +1,147 @@
+import argparse, concurrent.futures, glob, sys
+import xml.etree.ElementTree as ET
+import numpy as np
+import kick2svg, raster, rom, bootlogo
+
+# Check that a patched ROM draws the same logo as the original: both logos are rendered the way the Kickstart draws them and
+# compared pixel by pixel in RGB, so a different pen numbering doesn't count as a difference. For differing logos the report
+# names the first draw command that drew a wrong pixel, and where the vector and bitmap streams differ byte by byte.
+# With --roundtrip every ROM is extracted to SVG, converted back and patched into itself, which has to give the same logo.
+
+def load(data):
+    convert = kick2svg.Convert()
+    convert.load_data(data)
+    return convert
+
+def rgb(convert, fb):
+    pal = np.array(convert.pal, dtype=np.uint8).reshape(-1, 4)[:, :3]
+    return pal[fb]
+
+def owners(convert):
+    # the logo drawn one command at a time, with the index of the command that last changed each pixel (-1 for none).
+    # Bitmaps are numbered after the vector commands.
+    fb = raster.new_frame()
+    owner = np.full(fb.shape, -1, dtype=np.int32)
+    for i, op in enumerate(convert.ops):
+        before = fb.copy()
+        raster.draw_ops(fb, [op], 70, 40)
+        owner[fb != before] = i
+    for i, ((x,y), bm) in enumerate(convert.bitmaps):
+        before = fb.copy()
+        raster.draw_bitmap(fb, x+70, y+40, bm)
+        owner[fb != before] = len(convert.ops) + i
+    return owner
+
+def stream_diff(a, b):
+    # (offset, length) of every run of differing bytes, a missing byte on either side counts as different
+    n = max(len(a), len(b))
+    x = np.full(n, -1, dtype=np.int16)
+    y = np.full(n, -1, dtype=np.int16)
+    x[:len(a)] = np.frombuffer(bytes(a), dtype=np.uint8)
+    y[:len(b)] = np.frombuffer(bytes(b), dtype=np.uint8)
+    edges = np.diff(np.concatenate(([0], (x != y).view(np.int8), [0])))
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    return [(int(s), int(e - s)) for s, e in zip(starts, ends)]
+
+def image_stream(convert):
+    # the bitmap blocks up to the end marker, what follows is left over from an earlier logo
+    end = rom.parse_images(convert.images, 0, len(convert.images))
+    return convert.images[:end] if end != None else convert.images
+
+def compare(original, patched):
+    # compare two ROM images, returns a report dict
+    a, b = load(original), load(patched)
+    report = {"version": a.layout["version"]}
+    fa, fb = a.render(), b.render()
+    wrong = (rgb(a, fa) != rgb(b, fb)).any(axis=2)
+    report["pixels"] = int(np.count_nonzero(wrong))
+    if report["pixels"] > 0:
+        ys, xs = np.nonzero(wrong)
+        report["bbox"] = (int(xs.min()), int(ys.min()), int(xs.max()), int(ys.max()))
+        culprits = np.unique(owners(b)[wrong])
+        culprits = culprits[culprits >= 0]
+        if len(culprits) > 0:
+            i = int(culprits[0])
+            report["first_op"] = (i, repr(b.ops[i]) if i < len(b.ops) else "bitmap %i at %s" % (i - len(b.ops), b.bitmaps[i - len(b.ops)][0]))
+        else:
+            # only pixels that were never drawn, so the background colour differs
+            report["first_op"] = None
+    report["op_difference"] = kick2svg.first_difference(a.ops, b.ops)
+    report["vectors"] = stream_diff(kick2svg.encode_vectors(a.ops), kick2svg.encode_vectors(b.ops))
+    report["images"] = stream_diff(image_stream(a), image_stream(b))
+    report["palette"] = [i for i in range(4) if a.pal[i*4:i*4+3] != b.pal[i*4:i*4+3]]
+    return report
+
+def roundtrip(data):
+    # extract the logo, convert it back and patch it into the same ROM
+    svg = ET.tostring(bootlogo.extract_svg(data), encoding="utf-8", xml_declaration=True)
+    return bootlogo.patch(data, svg)
+
+def job(pair):
+    original, patched = pair
+    result = {"original":original, "patched":patched}
+    try:
+        with open(original, "rb") as f:
+            data = f.read()
+        if patched == None:
+            patched_data = roundtrip(data)
+        else:
+            with open(patched, "rb") as f:
+                patched_data = f.read()
+        result.update(compare(data, patched_data))
+    except Exception as e:
+        result["error"] = "%s: %s" % (type(e).__name__, e)
+    return result
+
+def run(pairs, workers=None):
+    # compare (original, patched) pairs on a process pool, patched None means round trip, results come back in order
+    if len(pairs) == 1:
+        return [job(pairs[0])]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(job, pairs))
+
+def describe(runs):
+    return ", ".join("0x%x-0x%x" % (s, s + n - 1) if n > 1 else "0x%x" % s for s, n in runs)
+
+def print_report(result):
+    name = "%s -> %s" % (result["original"], result["patched"] if result["patched"] != None else "round trip")
+    if "error" in result:
+        print("%s: error: %s" % (name, result["error"]))
+        return
+    print("%s: %s" % (name, "same logo" if result["pixels"] == 0 else "%i pixels differ in (%i,%i)-(%i,%i)" % ((result["pixels"],) + result["bbox"])))
+    if result["pixels"] > 0:
+        if result["first_op"] != None:
+            print("  first offending op: #%i %s" % result["first_op"])
+        else:
+            print("  only the background differs")
+    if result["op_difference"] != None:
+        print("  draw commands differ from #%i" % result["op_difference"])
+    for region in ("vectors", "images"):
+        if len(result[region]) > 0:
+            print("  %s: %i bytes differ at %s" % (region, sum(n for s, n in result[region]), describe(result[region])))
+    if len(result["palette"]) > 0:
+        print("  palette: pens %s differ" % ", ".join(str(i) for i in result["palette"]))
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the boot logos of Kickstart ROM images')
+    parser.add_argument('roms', type=str, nargs='+', help='original and patched ROM image, or with --roundtrip any number of ROM images (glob patterns are expanded)')
+    parser.add_argument('--roundtrip', action='store_true', help='extract every ROM to SVG, convert it back and compare the result with the original')
+    parser.add_argument('--jobs', type=int, help='number of worker processes (default: all cores)')
+
+    args = parser.parse_args()
+    if args.roundtrip:
+        pairs = [(path, None) for pattern in args.roms for path in (sorted(glob.glob(pattern)) or [pattern])]
+    elif len(args.roms) == 2:
+        pairs = [tuple(args.roms)]
+    else:
+        parser.error("give an original and a patched ROM image, or use --roundtrip")
+
+    ok = True
+    for result in run(pairs, args.jobs):
+        print_report(result)
+        ok = ok and "error" not in result and result["pixels"] == 0
+    if not ok:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
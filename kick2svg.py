@@ -1,6 +1,82 @@
 import base64, io, struct, argparse
-from PIL import Image, ImageDraw
+import array, functools
 import xml.etree.ElementTree as ET
+import numpy as np
+import raster, rom, animate
+
+def decode_bitmaps(images):
+    # decode the bitmap blocks into pen index arrays: each block is a >hBBBB header (pen, width in words, height, x, y)
+    # followed by height rows of 1-bit words, the list is terminated by a negative pen.
+    bitmaps = []
+    i = 0
+    while i + 6 <= len(images):
+        a,w,h,x,y = struct.unpack_from(">hBBBB", images, i)
+        if a < 0:
+            break
+        i += 6
+
+        rows = np.frombuffer(images, dtype=np.uint8, count=w*h*2, offset=i).reshape(h, w*2)
+        bitmaps.append(((x,y), np.unpackbits(rows, axis=1) * np.uint8(a)))
+
+        i += w*h*2
+    return bitmaps
+
+# The draw commands are a list of pairs: a 0xFF or 0xFE header with the pen starts a polyline or a list of flood fill seeds,
+# the following pairs are the x,y coordinates, and 0xFF 0xFF ends the list.
+
+class Op:
+    __slots__ = ("col", "points")
+
+    def __init__(self, col, points=b""):
+        self.col = col
+        # flat x,y coordinate bytes
+        self.points = array.array("B", points)
+
+    def xy(self):
+        return list(zip(self.points[0::2], self.points[1::2]))
+
+    def encode(self):
+        return bytes([self.cmd, self.col]) + self.points.tobytes()
+
+    def __eq__(self, other):
+        return type(self) == type(other) and self.col == other.col and self.points == other.points
+
+    def __repr__(self):
+        return "%s(%i, %s)" % (type(self).__name__, self.col, self.xy())
+
+class Polyline(Op):
+    __slots__ = ()
+    cmd = 0xFF
+
+class Fill(Op):
+    __slots__ = ()
+    cmd = 0xFE
+
+@functools.lru_cache(maxsize=64)
+def decode_vectors(vectors):
+    # decode the draw commands into a tuple of Polyline and Fill ops.
+    # The result is cached by the stream contents and shared, so don't modify it.
+    pairs = np.frombuffer(vectors, dtype=np.uint8, count=len(vectors)//2*2).reshape(-1, 2)
+    end = np.flatnonzero((pairs[:,0] == 0xFF) & (pairs[:,1] == 0xFF))
+    end = end[0] if len(end) > 0 else len(pairs)
+    heads = np.flatnonzero(pairs[:end,0] >= 0xFE).tolist()
+    ops = []
+    for i, j in zip(heads, heads[1:] + [end]):
+        a, b = vectors[i*2], vectors[i*2+1]
+        ops.append((Polyline if a == 0xFF else Fill)(b, vectors[i*2+2:j*2]))
+    return tuple(ops)
+
+def encode_vectors(ops):
+    return b"".join(op.encode() for op in ops) + bytes([0xFF, 0xFF])
+
+def first_difference(a, b):
+    # index of the first op that differs between two op lists, or None if they are the same
+    for i, (x, y) in enumerate(zip(a, b)):
+        if x != y:
+            return i
+    if len(a) != len(b):
+        return min(len(a), len(b))
+    return None
 
 class Convert:
     def __init__(self):
@@ -24,11 +100,17 @@ class Convert:
         circle = ET.SubElement(g, "circle", cx=str(x), cy=str(y), r="0.5", fill=self.colname[col], stroke="none")
 
     def load(self, path):
-        with open(path, "rb") as f:
-            data = f.read()
+        # map the ROM instead of reading all of it
+        self.load_data(rom.open_rom(path))
+
+    def load_data(self, data):
+        # find the logo
+        self.layout = rom.lookup(data)
+        if self.layout["swapped"]:
+            data = rom.swap(data)
+        palette, vectors, images = rom.regions(data, self.layout)
 
         # grab palette
-        palette = data[0x2872A:0x2872A+8]
         self.pal = []
         for i in range(4):
             r = palette[i*2+0] & 0xF
@@ -38,71 +120,68 @@ class Convert:
 
             self.pal.extend([r+r*16, g+g*16, b+b*16,a*254])
 
-        # grab vector data
-        self.vectors = data[0x289d0:0x28b6c]
+        # grab vector data (copied, it is small and the decoded ops are cached by its contents)
+        self.vectors = bytes(vectors)
+        self.ops = decode_vectors(self.vectors)
 
         # grab bitmap data
-        self.images = data[0x28B6C:0x28C9C+6]
+        self.images = bytes(images)
+        self.bitmaps = decode_bitmaps(self.images)
 
         # print (len(vectors), len(images))
 
-    def save_png(self, path):
-        # Export as bitmap:
-        image = Image.new("P", (320, 200))
-        image.putpalette(self.pal, "RGBX")
-        draw = ImageDraw.Draw(image)
-
+    def render(self):
+        # draw the logo like the Kickstart does, returns the 320x200 framebuffer of pen indices
         ox = 70
         oy = 40
 
-        cmd = 0
-        col = 0
-        polygon = []
-        for i in range(len(self.vectors)//2):
-            a,b = self.vectors[i*2],self.vectors[i*2+1]
-            if (a,b) == (0xFF,0xFF):
-                break
-            elif a == 0xFF or a == 0xFE:
-                if len(polygon) > 0:
-                    for i in range(len(polygon)-1):
-                        draw.line(polygon[i:i+2], fill=col)
-                polygon = []
-
-                (cmd,col) = a,b
-            else:
-                if cmd == 0xFF:
-                    polygon.append((a+ox, b+oy))
-                elif cmd == 0xFE:
-                    ImageDraw.floodfill(image, (a+ox, b+oy), col)
-
-        if len(polygon) > 0:
-            for i in range(len(polygon)-1):
-                draw.line(polygon[i:i+2], fill=col)
-
-        i = 0
-        while i < len(self.images):
-            a,w,h,x,y = struct.unpack_from(">hBBBB", self.images, i)
-            if a < 0:
-                break
-            i += 6
-
-            bm = Image.new("P", (w*16,h))
-            bm.putpalette(self.pal, "RGBA")
+        fb = raster.new_frame()
+        raster.draw_ops(fb, self.ops, ox, oy)
+        for (x,y), bm in self.bitmaps:
+            raster.draw_bitmap(fb, x+ox, y+oy, bm)
+        return fb
 
-            for r in range(h):
-                for c in range(w):
-                    val, = struct.unpack_from(">H", self.images, i + r*w*2 + c*2)
-                    for v in range(16):
-                        if val & 0x8000 != 0:
-                            bm.putpixel((c*16+v,r), a)
-                        val <<= 1
-            image.paste(bm, (x+ox,y+oy))
+    def replay(self):
+        # draw the logo step by step like the Kickstart does: yields the framebuffer before anything is drawn and after every
+        # polyline, fill seed and bitmap. It is the same array every time, drawn on further.
+        ox = 70
+        oy = 40
 
-            i += w*h*2
+        fb = raster.new_frame()
+        yield fb
+        for op in self.ops:
+            if op.cmd == 0xFF:
+                raster.draw_polyline(fb, [(x+ox, y+oy) for x, y in op.xy()], op.col)
+                yield fb
+            else:
+                for x, y in op.xy():
+                    raster.flood_fill(fb, x+ox, y+oy, op.col)
+                    yield fb
+        for (x,y), bm in self.bitmaps:
+            raster.draw_bitmap(fb, x+ox, y+oy, bm)
+            yield fb
+
+    def save_animation(self, path, delay=40, hold=2000):
+        # GIF, APNG (.png or .apng) or raw RGB frames, by the file extension
+        ext = path.lower().rsplit(".", 1)[-1]
+        kind = {"gif":"gif", "png":"apng", "apng":"apng"}.get(ext, "raw")
+        with open(path, "wb") as f:
+            return animate.animate(self.replay(), f, self.pal, kind, delay, hold)
+
+    def image(self):
+        # the rendered logo as a Pillow palette image
+        from PIL import Image
+        image = Image.fromarray(self.render(), "P")
+        image.putpalette(self.pal, "RGBX")
+        return image
 
-        image.save(path)
+    def save_png(self, path):
+        # Export as bitmap:
+        self.image().save(path, format="PNG")
 
-    def save_svg(self, path):
+    def svg(self):
+        # the logo as an SVG element tree
+        from PIL import Image
         # create lookup from pen index to colour:
         self.colname = {}
         for i in range(4):
@@ -123,62 +202,37 @@ class Convert:
         })
         g = ET.SubElement(svg, "g", style="image-rendering:pixelated", transform="translate(%i,%i)" % (ox,oy))
 
-        cmd = 0
-        col = 0
-        polygon = []
-        for i in range(len(self.vectors)//2):
-            a,b = self.vectors[i*2],self.vectors[i*2+1]
-            # print ("%2.2x %2.2x" % (a,b))
-            if (a,b) == (0xFF,0xFF):
-                break
-            elif a == 0xFF or a == 0xFE:
-                if len(polygon) > 0:
-                    self.polygon(g, polygon, col)
-                    polygon = []
-                (cmd,col) = a,b
+        for op in self.ops:
+            if op.cmd == 0xFF:
+                if len(op.points) > 0:
+                    self.polygon(g, op.xy(), op.col)
             else:
-                if cmd == 0xFF:
-                    polygon.append((a,b))
-                elif cmd == 0xFE:
-                    if len(polygon) > 0:
-                        self.polygon(g, polygon, col)
-                        polygon = []
-                    self.fill(g, (a,b), col)
-
-        i = 0
-        while i < len(self.images):
-            a,w,h,x,y = struct.unpack_from(">hBBBB", self.images, i)
-            if a < 0:
-                break
-            i += 6
-
-            bm = Image.new("P", (w*16,h))
-            bm.putpalette(self.pal, "RGBA")
+                for pos in op.xy():
+                    self.fill(g, pos, op.col)
 
-            for r in range(h):
-                for c in range(w):
-                    val, = struct.unpack_from(">H", self.images, i + r*w*2 + c*2)
-                    for v in range(16):
-                        if val & 0x8000 != 0:
-                            bm.putpixel((c*16+v,r), a)
-                        val <<= 1
+        for (x,y), pens in self.bitmaps:
+            bm = Image.fromarray(pens, "P")
+            bm.putpalette(self.pal, "RGBA")
             with io.BytesIO() as output:
                 bm.save(output, format="PNG")
                 bmdata = output.getvalue()
 
             image = ET.SubElement(g, "image", x=str(x), y=str(y), width=str(bm.width), height=str(bm.height))
             image.set("xlink:href", "data:image/png;base64," + base64.b64encode(bmdata).decode("utf-8"))
+        return svg
 
-            i += w*h*2
-
+    def save_svg(self, path):
         with open(path, 'wb') as f:
-            ET.ElementTree(svg).write(f, encoding='utf-8', xml_declaration=True)
+            ET.ElementTree(self.svg()).write(f, encoding='utf-8', xml_declaration=True)
 
 def main():
     parser = argparse.ArgumentParser(description='Extract Amiga boot logo from Kickstart 1.3 ROM')
     parser.add_argument('kick', type=str, help='Kickstart ROM image')
     parser.add_argument('--png',  type=str, help='output as PNG file')
     parser.add_argument('--svg',  type=str, help='output as SVG file')
+    parser.add_argument('--animate', type=str, help='output the logo being drawn as GIF, APNG (.png/.apng) or raw RGB frames (any other extension)')
+    parser.add_argument('--delay', type=int, default=40, help='milliseconds per animation step')
+    parser.add_argument('--hold', type=int, default=2000, help='milliseconds the finished logo is shown at the end of the animation')
 
     args = parser.parse_args()
     if args.kick != None:
@@ -189,7 +243,9 @@ def main():
             convert.save_png(args.png)
         if args.svg != None:
             convert.save_svg(args.svg)
-        if args.png == None and args.svg == None:
+        if args.animate != None:
+            convert.save_animation(args.animate, args.delay, args.hold)
+        if args.png == None and args.svg == None and args.animate == None:
             convert.save_svg("logo.svg")
 
 if __name__ == "__main__":
@@ -0,0 +1,133 @@
+import numpy as np
+
+# Rasterizer that follows what graphics.library does when the Kickstart draws the boot logo, on a uint8 framebuffer of pen indices.
+# Lines are stepped like the blitter line mode (Bresenham, starting at the first point, ties step the minor axis) and include both end points.
+# Flood fills are colour mode fills: the 4-connected area of the seed's colour is replaced.
+
+def new_frame(width=320, height=200):
+    return np.zeros((height, width), dtype=np.uint8)
+
+def line_points(x0, y0, x1, y1):
+    # pixels of a line from (x0,y0) to (x1,y1), returned as x and y arrays
+    dx, dy = x1 - x0, y1 - y0
+    major, minor = max(abs(dx), abs(dy)), min(abs(dx), abs(dy))
+    i = np.arange(major + 1)
+    if major == 0:
+        return np.array([x0]), np.array([y0])
+    steps = (2*minor*i + major) // (2*major)
+    sx, sy = (1 if dx >= 0 else -1), (1 if dy >= 0 else -1)
+    if abs(dx) >= abs(dy):
+        return x0 + sx*i, y0 + sy*steps
+    return x0 + sx*steps, y0 + sy*i
+
+def draw_line(fb, x0, y0, x1, y1, col):
+    xs, ys = line_points(x0, y0, x1, y1)
+    inside = (xs >= 0) & (xs < fb.shape[1]) & (ys >= 0) & (ys < fb.shape[0])
+    fb[ys[inside], xs[inside]] = col
+
+def draw_polyline(fb, points, col):
+    for (x0, y0), (x1, y1) in zip(points, points[1:]):
+        draw_line(fb, x0, y0, x1, y1, col)
+
+def flood_runs(fb, x, y):
+    # the 4-connected area with the colour of (x,y), as a list of (row, start, end) runs.
+    # Scanline fill: the rows are split into runs of the seed colour, and runs touching a filled run in the row above or below are filled as well.
+    h, w = fb.shape
+    pad = np.zeros((h, w + 2), dtype=bool)
+    pad[:, 1:-1] = fb == fb[y, x]
+    starts = np.flatnonzero(pad[:, 1:] & ~pad[:, :-1])
+    ends = np.flatnonzero(pad[:, :-1] & ~pad[:, 1:])
+    rows = starts // (w + 1)
+    starts -= rows * (w + 1)
+    ends -= rows * (w + 1)
+    first = np.searchsorted(rows, np.arange(h + 1)).tolist()
+    starts_l, ends_l, rows_l = starts.tolist(), ends.tolist(), rows.tolist()
+
+    seed = first[y] + int(np.searchsorted(starts[first[y]:first[y+1]], x, "right")) - 1
+    filled = {seed}
+    todo = [seed]
+    while todo:
+        i = todo.pop()
+        r, s, e = rows_l[i], starts_l[i], ends_l[i]
+        for nr in (r - 1, r + 1):
+            if nr < 0 or nr >= h:
+                continue
+            lo, hi = first[nr], first[nr+1]
+            # runs of the neighbouring row that overlap [s, e)
+            j = lo + int(np.searchsorted(ends[lo:hi], s, "right"))
+            while j < hi and starts_l[j] < e:
+                if j not in filled:
+                    filled.add(j)
+                    todo.append(j)
+                j += 1
+    return [(rows_l[i], starts_l[i], ends_l[i]) for i in filled]
+
+def flood_fill(fb, x, y, col):
+    if not (0 <= x < fb.shape[1] and 0 <= y < fb.shape[0]) or fb[y, x] == col:
+        return
+    for r, s, e in flood_runs(fb, x, y):
+        fb[r, s:e] = col
+
+def draw_ops(fb, ops, ox=0, oy=0):
+    # execute decoded draw commands (kick2svg.Polyline/Fill) with the logo offset
+    for op in ops:
+        if op.cmd == 0xFF:
+            draw_polyline(fb, [(x+ox, y+oy) for x, y in op.xy()], op.col)
+        else:
+            for x, y in op.xy():
+                flood_fill(fb, x+ox, y+oy, op.col)
+
+class LineCache:
+    # Pixels of the lines drawn so far, for callers that draw nearly the same ops over and over, like the optimizer of svg2kick.
+    # A polyline sets its pixels whatever is below them, so its pixels only have to be stepped once, and an edited polyline only
+    # steps the segments that changed. Both tables are emptied when they grow beyond their limit.
+    def __init__(self, shape=(200, 320), segments=1 << 16, polylines=64):
+        self.shape = shape
+        self.limits = (segments, polylines)
+        self.segments = {}
+        self.polylines = {}
+
+    def segment(self, x0, y0, x1, y1):
+        key = (x0, y0, x1, y1)
+        pixels = self.segments.get(key)
+        if pixels is None:
+            if len(self.segments) >= self.limits[0]:
+                self.segments.clear()
+            xs, ys = line_points(x0, y0, x1, y1)
+            inside = (xs >= 0) & (xs < self.shape[1]) & (ys >= 0) & (ys < self.shape[0])
+            pixels = (ys[inside] * self.shape[1] + xs[inside]).astype(np.int32)
+            self.segments[key] = pixels
+        return pixels
+
+    def polyline(self, points):
+        # flat indices of the pixels of a polyline
+        key = tuple(points)
+        pixels = self.polylines.get(key)
+        if pixels is None:
+            if len(self.polylines) >= self.limits[1]:
+                self.polylines.clear()
+            parts = [self.segment(x0, y0, x1, y1) for (x0, y0), (x1, y1) in zip(points, points[1:])]
+            pixels = np.concatenate(parts) if len(parts) > 0 else np.zeros(0, dtype=np.int32)
+            self.polylines[key] = pixels
+        return pixels
+
+    def draw_ops(self, fb, ops, ox=0, oy=0):
+        # draw_ops() with the lines taken from the cache
+        flat = fb.reshape(-1)
+        for op in ops:
+            if op.cmd == 0xFF:
+                flat[self.polyline([(x+ox, y+oy) for x, y in op.xy()])] = op.col
+            else:
+                for x, y in op.xy():
+                    flood_fill(fb, x+ox, y+oy, op.col)
+
+def draw_bitmap(fb, x, y, pens):
+    # paste the non-zero pixels of a pen index array at (x,y)
+    h, w = fb.shape
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + pens.shape[1], w), min(y + pens.shape[0], h)
+    if x0 >= x1 or y0 >= y1:
+        return
+    src = pens[y0-y:y1-y, x0-x:x1-x]
+    dst = fb[y0:y1, x0:x1]
+    dst[src != 0] = src[src != 0]
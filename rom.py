@@ -0,0 +1,216 @@
+import hashlib, json, mmap, os
+import numpy as np
+
+# Find the boot logo in a Kickstart image instead of relying on the offsets of one 1.3 build.
+# The logo is a palette of four 12-bit colours, the vector draw commands and the bitmap blocks. They are found by scanning for a
+# vector stream that parses, followed by a bitmap block list that parses, and the results are kept in an index keyed by the hash
+# of the image, so a ROM is only scanned once.
+
+# Kickstart 1.3 (34.5): palette at 0x2872A, vectors at 0x289d0, bitmaps at 0x28B6C. The regions are laid out the same way
+# relative to each other in the other builds we know of.
+PALETTE_DELTA = 0x289d0 - 0x2872A
+VECTOR_SIZE = 0x28B6C - 0x289d0
+IMAGE_SIZE = 0x28C9C + 6 - 0x28B6C
+DEFAULT_PALETTE = bytes([0x0F, 0xFF, 0x00, 0x00, 0x07, 0x7C, 0x0B, 0xBB])
+
+VERSIONS = {30:"1.0", 31:"1.1", 32:"1.1", 33:"1.2", 34:"1.3"}
+
+# (palette, vectors, bitmaps) of the builds whose offsets we know, by (version, revision) from the ROM header. These are checked
+# before scanning, a logo that svg2kick patched may be too short to tell apart from other data.
+KNOWN = {(34, 5): (0x2872A, 0x289d0, 0x28B6C)}
+
+INDEX = os.environ.get("AMIGABOOTLOGO_INDEX", os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "amigabootlogo", "index.json"))
+
+def open_rom(path, mode="r"):
+    # memory map a ROM image instead of reading it: "r" read only, "c" private copy on write (changes stay in memory
+    # and only the touched pages are copied), "w" changes are written back to the file
+    access = {"r":mmap.ACCESS_READ, "c":mmap.ACCESS_COPY, "w":mmap.ACCESS_WRITE}[mode]
+    with open(path, "r+b" if mode == "w" else "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=access)
+
+def regions(data, layout, copy=0):
+    # zero-copy views of the palette, vector and bitmap regions of an unswapped image
+    view = memoryview(data)
+    base = layout["copies"][copy]
+    palette = base + layout["palette"]
+    vectors = base + layout["vectors"]
+    images = base + layout["images"]
+    return view[palette:palette+8], view[vectors:vectors+layout["vector_size"]], view[images:images+layout["image_size"]]
+
+def write_atomic(path, data):
+    # write to a temporary file next to the target and rename it over the target, so nobody sees a half written file.
+    # The temporary file is created like open() would, so it gets the permissions a normally created file would have, an
+    # existing target keeps its permissions.
+    while True:
+        tmp = os.path.join(os.path.dirname(os.path.abspath(path)), ".%s.%s" % (os.path.basename(path), os.urandom(4).hex()))
+        try:
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o666)
+            break
+        except FileExistsError:
+            continue
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        if os.path.exists(path):
+            os.chmod(tmp, os.stat(path).st_mode & 0o777)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def swap(data):
+    # swap the bytes of every 16-bit word, for images dumped from an EPROM with the wrong byte order
+    return np.frombuffer(data, dtype="<u2", count=len(data)//2).astype(">u2").tobytes() + bytes(data[len(data)//2*2:])
+
+def header(data):
+    # the ROM size from the magic at the start of the image, and whether it is byte swapped
+    magic = bytes(data[0:4])
+    for size, swapped_magic in ((256*1024, b"\x11\x11\x4e\xf9"), (512*1024, b"\x11\x14\x4e\xf9")):
+        if magic == swapped_magic:
+            return size, False
+        if magic == swap(swapped_magic):
+            return size, True
+    return None, None
+
+def parse_vectors(data, ofs, limit):
+    # end of a plausible vector stream starting at ofs, or None. A logo may be a single polyline or fill, or no draw commands
+    # at all (only bitmaps), then the stream is just the end marker.
+    end = min(len(data) - 1, ofs + limit)
+    i = ofs
+    while i < end:
+        a, b = data[i], data[i+1]
+        if (a, b) == (0xFF, 0xFF):
+            return i + 2
+        if a >= 0xFE:
+            if b > 3:
+                return None
+        elif i == ofs:
+            return None
+        i += 2
+    return None
+
+def parse_images(data, ofs, limit):
+    # end of a plausible bitmap block list starting at ofs, or None. The list ends with a pen of -1.
+    end = min(len(data), ofs + limit)
+    i = ofs
+    while i + 2 <= end:
+        pen = int.from_bytes(data[i:i+2], "big", signed=True)
+        if pen == -1:
+            return i + 2
+        if pen < 0 or pen > 3 or i + 6 > end:
+            return None
+        w, h = data[i+2], data[i+3]
+        if w == 0 or h == 0:
+            return None
+        i += 6 + w*h*2
+    return None
+
+def palette_at(data, ofs):
+    # whether there are four 12 bit colours at ofs
+    return ofs >= 0 and all(data[ofs+i*2] <= 0x0F for i in range(4))
+
+def at_known(data):
+    # offsets (palette, vectors, images) of the logo if the image is a build in KNOWN and the logo parses there, or None
+    palette, vectors, images = KNOWN.get((int.from_bytes(data[12:14], "big"), int.from_bytes(data[14:16], "big")), (-1, -1, -1))
+    if vectors < 0 or parse_vectors(data, vectors, VECTOR_SIZE) == None or parse_images(data, images, IMAGE_SIZE) == None or not palette_at(data, palette):
+        return None
+    return palette, vectors, images
+
+def scan(data):
+    # absolute offsets (palette, vectors, images) of the logo in an unswapped image, or None
+    d = np.frombuffer(data, dtype=np.uint8, count=len(data)//2*2).reshape(-1, 2)
+    # streams start with a polyline (0xFF) or, if the first element is a filled shape, a fill (0xFE), or are only the end marker
+    candidates = (np.flatnonzero((d[:,0] == 0xFF) | ((d[:,0] == 0xFE) & (d[:,1] < 4))) * 2).tolist()
+    best = None
+    for v in candidates:
+        end = parse_vectors(data, v, VECTOR_SIZE)
+        if end == None:
+            continue
+        # a patched stream may be shorter than the region, so try the usual region size before the end of the stream.
+        # A stream that is only the end marker is everywhere, it has to be followed by the bitmaps at the usual distance.
+        empty = end == v + 2
+        for images in ((v + VECTOR_SIZE,) if empty else (v + VECTOR_SIZE, end)):
+            if parse_images(data, images, IMAGE_SIZE) != None:
+                # rank on the bitmaps and the palette being where 1.3 keeps them, then the first candidate wins: the leftovers
+                # of a longer logo that was replaced come after the stream that replaced them
+                palette = int(palette_at(data, v - PALETTE_DELTA))
+                if palette and bytes(data[v-PALETTE_DELTA:v-PALETTE_DELTA+8]) == DEFAULT_PALETTE:
+                    palette = 2
+                if empty and palette == 0:
+                    break
+                score = (images == v + VECTOR_SIZE, palette, not empty, -v)
+                if best == None or score > best[0]:
+                    best = (score, v, images)
+                break
+    if best == None:
+        return None
+    _, v, images = best
+    palette = v - PALETTE_DELTA
+    if not palette_at(data, palette):
+        # not where 1.3 keeps it, look for the default palette close to the draw commands
+        palette = bytes(data).rfind(DEFAULT_PALETTE, max(0, v - 0x1000), v)
+        if palette < 0:
+            return None
+    return palette, v, images
+
+def locate(data):
+    # identify the image and find the logo, returns a layout dict with the offsets relative to the start of each copy of the ROM
+    size, swapped = header(data)
+    known = size != None
+    orders = [swapped] if swapped != None else [False, True]
+    for swapped in orders:
+        rom = swap(data) if swapped else bytes(data)
+        found = (at_known(rom) if known else None) or scan(rom)
+        if found == None:
+            continue
+        palette, vectors, images = found
+        if size == None or size > len(rom):
+            size = len(rom)
+        # overdumps repeat the ROM, the logo has to be patched in every copy
+        base = vectors // size * size
+        copies = [b for b in range(0, len(rom) - size + 1, size) if rom[b:b+size] == rom[base:base+size]]
+        version = "unknown"
+        if known:
+            major = int.from_bytes(rom[base+12:base+14], "big")
+            minor = int.from_bytes(rom[base+14:base+16], "big")
+            version = "%s (%i.%i)" % (VERSIONS.get(major, "unknown"), major, minor)
+        return {
+            "version": version,
+            "swapped": swapped,
+            "size": size,
+            "copies": copies,
+            "palette": palette - base,
+            "vectors": vectors - base,
+            "images": images - base,
+            "vector_size": images - vectors,
+            "image_size": IMAGE_SIZE,
+        }
+    raise ValueError("no boot logo found in ROM image")
+
+# layouts already looked up by this process
+layouts = {}
+
+def lookup(data, index=None):
+    # locate() through the persistent index
+    index = INDEX if index == None else index
+    key = hashlib.sha1(data).hexdigest()
+    if key in layouts:
+        return layouts[key]
+    try:
+        with open(index, "r") as f:
+            entries = json.load(f)
+    except (OSError, ValueError):
+        entries = {}
+    if key in entries:
+        layouts[key] = entries[key]
+        return entries[key]
+
+    layout = locate(data)
+    layouts[key] = layout
+    entries[key] = layout
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(index)), exist_ok=True)
+        write_atomic(index, json.dumps(entries, indent=1).encode("utf-8"))
+    except OSError:
+        pass
+    return layout
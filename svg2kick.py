@@ -1,23 +1,24 @@
-import io, struct, math, argparse
+import io, os, struct, math, argparse, sys
+import glob, functools, concurrent.futures
+import contextlib, json, time, cProfile, hashlib
 import re
-from PIL import Image, ImageDraw
+import numpy as np
 import xml.etree.ElementTree as ET
-from urllib.request import urlopen
+import kick2svg, raster, rom, cache
 
 # convert an SVG file into an Amiga Boot logo
 # This is by no means a proper SVG renderer/converter, it is just enough that you can edit the art in Inkscape and convert it back into the correct vector format.
 # There are 412 byte available for the vector and 310 byte for bitmaps. You COULD probably relocate it into an area with more space or use a larger EPROM, but I don't know enough about the Kickstart to do this.
 
-# (right now I'm not converting bitmap data!)
-
 def add(a, b):
     return (a[0]+b[0], a[1]+b[1])
    
-def add_cond(cond, a, b):
-    if cond:
-        return a
-    else:
-        return add(a,b)
+def lerp(a, b, t=0.5):
+    return (a[0]+(b[0]-a[0])*t, a[1]+(b[1]-a[1])*t)
+
+def reflect(p, c):
+    # p mirrored at c
+    return (2*c[0]-p[0], 2*c[1]-p[1])
 
 def round_vec(v):
     return (int(round(v[0])), int (round(v[1])))
@@ -33,86 +34,786 @@ def diff(a,b):
     d1,d2 = a[0]-b[0],a[1]-b[1]
     return d1*d1+d2*d2
 
+# SVG path data: number of arguments per command, and the tokens. Arc flags are a single digit and may be written without a separator.
+PATH_ARGS = {"m":2, "l":2, "h":1, "v":1, "c":6, "s":4, "q":4, "t":2, "a":7, "z":0}
+PATH_CMD = re.compile(r"[\s,]*([MmZzLlHhVvCcSsQqTtAa])")
+PATH_NUM = re.compile(r"[\s,]*([-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?)")
+PATH_FLAG = re.compile(r"[\s,]*([01])")
+PATH_END = re.compile(r"[\s,]*$")
+
+def path_commands(d):
+    # tokenize path data in one pass, yields (command, arguments) with implicit repeats spelled out
+    pos = 0
+    cmd = None
+    while not PATH_END.match(d, pos):
+        m = PATH_CMD.match(d, pos)
+        if m:
+            cmd = m.group(1)
+            pos = m.end()
+        elif cmd == None or cmd in "Zz":
+            print("unknown op %s" % d[pos:].strip()[:1])
+            return
+        args = []
+        for i in range(PATH_ARGS[cmd.lower()]):
+            m = (PATH_FLAG if cmd in "Aa" and i in (3, 4) else PATH_NUM).match(d, pos)
+            if not m:
+                print("bad arguments for op %s" % cmd)
+                return
+            args.append(float(m.group(1)))
+            pos = m.end()
+        yield cmd, args
+        # extra coordinate pairs after a move are line segments
+        if cmd == "M":
+            cmd = "L"
+        elif cmd == "m":
+            cmd = "l"
+
+def flatten_cubic(p0, p1, p2, p3, tolerance, out):
+    # subdivide until the control points are within tolerance of the chord, appends the points after p0 to out
+    stack = [(p0, p1, p2, p3)]
+    while stack:
+        p0, p1, p2, p3 = stack.pop()
+        dx, dy = p3[0]-p0[0], p3[1]-p0[1]
+        chord = dx*dx + dy*dy
+        if chord < 1e-12:
+            flat = max(diff(p0, p1), diff(p0, p2)) <= tolerance*tolerance
+        else:
+            d1 = abs((p1[0]-p3[0])*dy - (p1[1]-p3[1])*dx)
+            d2 = abs((p2[0]-p3[0])*dy - (p2[1]-p3[1])*dx)
+            flat = (d1 + d2)**2 <= tolerance*tolerance * chord
+        if flat:
+            out.append(p3)
+            continue
+        p01, p12, p23 = lerp(p0, p1), lerp(p1, p2), lerp(p2, p3)
+        p012, p123 = lerp(p01, p12), lerp(p12, p23)
+        mid = lerp(p012, p123)
+        stack.append((mid, p123, p23, p3))
+        stack.append((p0, p01, p012, mid))
+
+def flatten_arc(p0, rx, ry, angle, large, sweep, p1, tolerance, out):
+    # endpoint to centre parameterization as described in the SVG implementation notes
+    if p0 == p1:
+        return
+    rx, ry = abs(rx), abs(ry)
+    if rx == 0 or ry == 0:
+        out.append(p1)
+        return
+    phi = math.radians(angle)
+    cos, sin = math.cos(phi), math.sin(phi)
+    hx, hy = (p0[0]-p1[0])/2, (p0[1]-p1[1])/2
+    x1, y1 = cos*hx + sin*hy, -sin*hx + cos*hy
+    scale = (x1*x1)/(rx*rx) + (y1*y1)/(ry*ry)
+    if scale > 1:
+        rx, ry = rx*math.sqrt(scale), ry*math.sqrt(scale)
+    num = rx*rx*ry*ry - rx*rx*y1*y1 - ry*ry*x1*x1
+    den = rx*rx*y1*y1 + ry*ry*x1*x1
+    f = math.sqrt(max(num, 0) / den)
+    if large == sweep:
+        f = -f
+    cx1, cy1 = f*rx*y1/ry, -f*ry*x1/rx
+    cx = cos*cx1 - sin*cy1 + (p0[0]+p1[0])/2
+    cy = sin*cx1 + cos*cy1 + (p0[1]+p1[1])/2
+    theta = math.atan2((y1-cy1)/ry, (x1-cx1)/rx)
+    delta = math.atan2((-y1-cy1)/ry, (-x1-cx1)/rx) - theta
+    if sweep and delta < 0:
+        delta += 2*math.pi
+    elif not sweep and delta > 0:
+        delta -= 2*math.pi
+    # largest step that keeps the chord within tolerance of the arc
+    r = max(rx, ry)
+    step = 2*math.acos(1 - tolerance/r) if tolerance < r else math.pi/2
+    n = max(1, int(math.ceil(abs(delta)/step)))
+    for i in range(1, n):
+        t = theta + delta*i/n
+        x, y = rx*math.cos(t), ry*math.sin(t)
+        out.append((cos*x - sin*y + cx, sin*x + cos*y + cy))
+    out.append(p1)
+
+def flatten_path(d, tolerance=0.5):
+    # interpret path data, yields every subpath as a list of points with curves turned into line segments
+    pos = (0,0)
+    start = pos
+    ctrl = None
+    poly = []
+    for op, args in path_commands(d):
+        absolute = op.isupper()
+        op = op.lower()
+        rel = (0,0) if absolute else pos
+        p = [add(rel, (args[i], args[i+1])) for i in range(0, len(args)-1, 2)]
+        prev = ctrl
+        ctrl = None
+        if op == "m":
+            if len(poly) > 1:
+                yield poly
+            pos = start = p[0]
+            poly = [pos]
+            continue
+        if len(poly) == 0:
+            poly = [pos]
+        if op == "l":
+            pos = p[0]
+            poly.append(pos)
+        elif op == "h":
+            pos = (args[0] + rel[0], pos[1])
+            poly.append(pos)
+        elif op == "v":
+            pos = (pos[0], args[0] + rel[1])
+            poly.append(pos)
+        elif op == "c":
+            flatten_cubic(pos, p[0], p[1], p[2], tolerance, poly)
+            ctrl, pos = ("c", p[1]), p[2]
+        elif op == "s":
+            c1 = reflect(prev[1], pos) if prev != None and prev[0] == "c" else pos
+            flatten_cubic(pos, c1, p[0], p[1], tolerance, poly)
+            ctrl, pos = ("c", p[0]), p[1]
+        elif op == "q" or op == "t":
+            if op == "q":
+                q, end = p[0], p[1]
+            else:
+                q = reflect(prev[1], pos) if prev != None and prev[0] == "q" else pos
+                end = p[0]
+            # a quadratic is a cubic with both control points 2/3 of the way to the quadratic control point
+            flatten_cubic(pos, lerp(pos, q, 2/3), lerp(end, q, 2/3), end, tolerance, poly)
+            ctrl, pos = ("q", q), end
+        elif op == "a":
+            end = add(rel, (args[5], args[6]))
+            flatten_arc(pos, args[0], args[1], args[2], args[3] != 0, args[4] != 0, end, tolerance, poly)
+            pos = end
+        elif op == "z":
+            poly.append(start)
+            yield poly
+            poly = []
+            pos = start
+    if len(poly) > 1:
+        yield poly
+
+# Transforms are affine matrices (a, b, c, d, e, f) as in the SVG matrix() transform.
+IDENTITY = (1, 0, 0, 1, 0, 0)
+TRANSFORM = re.compile(r"(matrix|translate|scale|rotate|skewX|skewY)\s*\(([^)]*)\)")
+
+def multiply(m, n):
+    # the transform that applies n first and then m
+    return (m[0]*n[0] + m[2]*n[1], m[1]*n[0] + m[3]*n[1],
+            m[0]*n[2] + m[2]*n[3], m[1]*n[2] + m[3]*n[3],
+            m[0]*n[4] + m[2]*n[5] + m[4], m[1]*n[4] + m[3]*n[5] + m[5])
+
+def transform_point(m, p):
+    return (m[0]*p[0] + m[2]*p[1] + m[4], m[1]*p[0] + m[3]*p[1] + m[5])
+
+def parse_transform(s):
+    # a transform attribute, a list of transform functions that are applied right to left
+    m = IDENTITY
+    for name, args in TRANSFORM.findall(s):
+        v = [float(x) for x in PATH_NUM.findall(args)]
+        if len(v) == 0:
+            continue
+        if name == "matrix" and len(v) == 6:
+            t = tuple(v)
+        elif name == "translate":
+            t = (1, 0, 0, 1, v[0], v[1] if len(v) > 1 else 0)
+        elif name == "scale":
+            t = (v[0], 0, 0, v[1] if len(v) > 1 else v[0], 0, 0)
+        elif name == "rotate":
+            a = math.radians(v[0])
+            t = (math.cos(a), math.sin(a), -math.sin(a), math.cos(a), 0, 0)
+            if len(v) == 3:
+                # rotate around (cx, cy)
+                t = multiply(multiply((1, 0, 0, 1, v[1], v[2]), t), (1, 0, 0, 1, -v[1], -v[2]))
+        elif name == "skewX":
+            t = (1, 0, math.tan(math.radians(v[0])), 1, 0, 0)
+        elif name == "skewY":
+            t = (1, math.tan(math.radians(v[0])), 0, 1, 0, 0)
+        else:
+            continue
+        m = multiply(m, t)
+    return m
+
+SVG = "{http://www.w3.org/2000/svg}"
+SHAPES = ("line", "polygon", "polyline", "rect", "path", "circle", "image")
+
+def primitives(source):
+    # Stream the shapes of an SVG file, yields (index of the top level element, tag, attributes, transform) in drawing order.
+    # Elements are dropped as soon as they are done, so only the groups around the current element are kept in memory,
+    # however large the document and its embedded images are.
+    stack = []
+    skip = 0
+    top = -1
+    for event, e in ET.iterparse(source, events=("start", "end")):
+        if event == "start":
+            if skip > 0:
+                skip += 1
+                continue
+            container = len(stack) == 1 or (len(stack) > 1 and stack[-1][0].tag == SVG + "g")
+            if len(stack) == 1:
+                top += 1
+            if len(stack) == 0 or (container and (e.tag == SVG + "g" or (e.tag.startswith(SVG) and e.tag[len(SVG):] in SHAPES))):
+                parent = stack[-1][1] if len(stack) > 0 else IDENTITY
+                stack.append((e, multiply(parent, parse_transform(e.get("transform", "")))))
+            else:
+                # metadata, definitions, and anything we can't draw, including everything inside it
+                if container:
+                    print (e.tag)
+                skip = 1
+            continue
+        if skip > 0:
+            skip -= 1
+            if skip > 0:
+                e.clear()
+                continue
+        else:
+            _, m = stack.pop()
+            tag = e.tag[len(SVG):]
+            if e.tag.startswith(SVG) and tag in SHAPES:
+                yield top, tag, dict(e.attrib), m
+        e.clear()
+        if len(stack) > 0:
+            stack[-1][0].remove(e)
+
 def project(v):
     p = clamp(v[0] - 70, 0, 253), clamp(v[1] - 40, 0, 255)
     return list(p)
 
-def remap_col(remap, col, used_cols, pal):
-    try:
-        return remap[col]
-    except KeyError:
-        bestIdx = -1
-        bestDiff = -1
-        for idx,val in enumerate(used_cols):
-            d = diff(col, val)
-            if bestIdx < 0 or d < bestDiff:
-                bestIdx = idx
-                bestDiff = d
-        idx = len(pal)
-        remap[col] = idx
-        pal.append(used_cols[bestIdx])
-        return idx
+def ocs_keys(im):
+    # the 12-bit OCS colour (0xRGB) of every pixel of an RGB image, or of a single (r,g,b) colour
+    a = np.asarray(im, dtype=np.uint16) >> 4
+    return (a[...,0] << 8) | (a[...,1] << 4) | a[...,2]
+
+def ocs_rgb(col):
+    c = int(col)
+    return ((c >> 8) * 0x11, (c >> 4 & 0xF) * 0x11, (c & 0xF) * 0x11)
+
+def quantize(keys, background, order=(), pens=4):
+    # Pick the palette for a screen of 12-bit colours: pen 0 is the background, the other pens are the most frequent colours,
+    # and if there are more colours than pens they are refined by weighted k-means over the colour histogram.
+    # Pens are numbered by their first use in order (the colours of the draw commands), so the result doesn't depend on anything
+    # but the input. Returns the palette as 12-bit colours and a 4096 entry table from colour to pen.
+    hist = np.bincount(np.asarray(keys).ravel(), minlength=4096)
+    used = np.flatnonzero(hist)
+    weights = hist[used].astype(np.float64)
+    rgb = np.stack([used >> 8, used >> 4 & 0xF, used & 0xF], axis=1).astype(np.float64)
+    by_count = used[np.lexsort((used, -hist[used]))].tolist()
+    palette = [background] + [c for c in by_count if c != background][:pens-1]
+
+    def nearest(cols):
+        pal = np.array([[c >> 8, c >> 4 & 0xF, c & 0xF] for c in palette], dtype=np.float64)
+        return ((cols[:,None,:] - pal[None,:,:])**2).sum(axis=2).argmin(axis=1)
+
+    if len([c for c in used.tolist() if c != background]) > pens - 1:
+        for i in range(16):
+            assigned = nearest(rgb)
+            refined = [background]
+            for pen in range(1, len(palette)):
+                members = assigned == pen
+                if not members.any():
+                    refined.append(palette[pen])
+                    continue
+                r, g, b = np.round(np.average(rgb[members], axis=0, weights=weights[members])).astype(int).tolist()
+                refined.append(r << 8 | g << 4 | b)
+            if refined == palette:
+                break
+            palette = refined
+
+    all_cols = np.arange(4096)
+    lut = nearest(np.stack([all_cols >> 8, all_cols >> 4 & 0xF, all_cols & 0xF], axis=1).astype(np.float64))
+    first = {}
+    for i, c in enumerate(list(order) + by_count):
+        first.setdefault(int(lut[c]), i)
+    numbering = [0] + sorted(range(1, len(palette)), key=lambda pen: (first.get(pen, len(first) + pen), pen))
+    renumber = np.zeros(len(palette), dtype=np.uint8)
+    renumber[numbering] = np.arange(len(palette))
+    return [palette[pen] for pen in numbering], renumber[lut]
+
+def label_regions(keys):
+    # label 4-connected regions of equal colour, which is what a flood fill covers.
+    # Rows are split into runs of equal colour and vertically touching runs are joined: every run points at the smallest run it
+    # is known to be connected to, the pointers are followed to the end, and this is repeated on the arrays until nothing changes.
+    h, w = keys.shape
+    starts = np.ones((h, w), dtype=bool)
+    starts[:,1:] = keys[:,1:] != keys[:,:-1]
+    runs = np.cumsum(starts.ravel()).reshape(h, w) - 1
+    # two touching runs overlap in one stretch, which begins where one of them begins, so every pair is taken once
+    touch = (keys[1:] == keys[:-1]) & (starts[1:] | starts[:-1])
+    a, b = runs[1:][touch], runs[:-1][touch]
+    roots = np.arange(int(runs[-1,-1]) + 1)
+    while True:
+        low = np.minimum(roots[a], roots[b])
+        new = roots.copy()
+        np.minimum.at(new, roots[a], low)
+        np.minimum.at(new, roots[b], low)
+        while True:
+            jumped = new[new]
+            if np.array_equal(jumped, new):
+                break
+            new = jumped
+        if np.array_equal(new, roots):
+            break
+        roots = new
+    # the roots are the first run of each region, numbering them in order numbers the regions in the order they first appear
+    is_root = roots == np.arange(len(roots))
+    labels = np.cumsum(is_root)[roots] - 1
+    return labels[runs], int(is_root.sum())
+
+def word_sum(data):
+    # plain sum of the big endian 32-bit words, the uint64 accumulator can't overflow for any ROM size
+    return int(np.frombuffer(data, dtype=">u4", count=len(data)//4).sum(dtype=np.uint64))
+
+def rom_checksum(data):
+    # the Kickstart checksum is a sum of all 32-bit words with end-around carry, a valid ROM sums to 0xFFFFFFFF
+    total = word_sum(data)
+    checksum = total % 0xFFFFFFFF
+    if checksum == 0 and total != 0:
+        return 0xFFFFFFFF
+    return checksum
+
+def verify(data):
+    # check every copy of the ROM in the image, in the right byte order
+    size, swapped = rom.header(data)
+    data = rom.swap(data) if swapped else memoryview(data)
+    size = size or len(data)
+    return all(rom_checksum(data[base:base+size]) == 0xFFFFFFFF for base in range(0, len(data) - size + 1, size))
+
+def snap(v):
+    # screen position the Kickstart will draw a point at
+    x, y = project(v)
+    return (x + 70, y + 40)
+
+def encode(ops):
+    vectors = []
+    for op in ops:
+        vectors.extend(op)
+    vectors.extend([255,255])
+    return vectors
+
+# the optimizer and the fill solver draw the same polylines many times over
+LINES = raster.LineCache()
+
+def rasterize(ops, fb=None):
+    # render the ops the way the Kickstart draws them, optionally on top of an already rendered prefix
+    fb = raster.new_frame() if fb is None else fb.copy()
+    LINES.draw_ops(fb, kick2svg.decode_vectors(bytes(encode(ops))), 70, 40)
+    return fb
+
+def collinear(a, b, c):
+    # b lies on the way from a to c
+    d1 = (b[0]-a[0], b[1]-a[1])
+    d2 = (c[0]-b[0], c[1]-b[1])
+    return d1[0]*d2[1] == d1[1]*d2[0] and d1[0]*d2[0] + d1[1]*d2[1] >= 0
+
+# Optimizer passes: each one walks the ops once and proposes edits, an edit is only kept if same() accepts the result.
+
+def merge_polylines(ops, same):
+    # a polyline that starts where the previous one in the same colour ended can continue it
+    i = 0
+    while i < len(ops)-1:
+        a, b = ops[i], ops[i+1]
+        if a[0] == b[0] == 0xFF and a[1] == b[1] and a[-2:] == b[2:4]:
+            candidate = ops[:i] + [a + b[4:]] + ops[i+2:]
+            if same(candidate):
+                ops = candidate
+                continue
+        i += 1
+    return ops
+
+def drop_points(ops, same):
+    # duplicate points and points in the middle of a straight run
+    for i in range(len(ops)):
+        j = 1
+        while ops[i][0] == 0xFF and j < (len(ops[i])-2)//2 and len(ops[i]) > 6:
+            op = ops[i]
+            prev, cur = tuple(op[j*2:j*2+2]), tuple(op[j*2+2:j*2+4])
+            nxt = tuple(op[j*2+4:j*2+6])
+            if cur == prev or (len(nxt) == 2 and collinear(prev, cur, nxt)):
+                candidate = ops[:i] + [op[:j*2+2] + op[j*2+4:]] + ops[i+1:]
+                if same(candidate):
+                    ops = candidate
+                    continue
+            j += 1
+    return ops
+
+def merge_fills(ops, same):
+    # consecutive fills in the same colour don't need their own header
+    i = 0
+    while i < len(ops)-1:
+        a, b = ops[i], ops[i+1]
+        if a[0] == b[0] == 0xFE and a[1] == b[1]:
+            candidate = ops[:i] + [a + b[2:]] + ops[i+2:]
+            if same(candidate):
+                ops = candidate
+                continue
+        i += 1
+    return ops
+
+def drop_fills(ops, same):
+    # fill seeds whose region is already filled by the time they run
+    i = 0
+    while i < len(ops):
+        j = 2
+        removed = False
+        while ops[i][0] == 0xFE and j < len(ops[i]):
+            op = ops[i]
+            if len(op) > 4:
+                candidate = ops[:i] + [op[:j] + op[j+2:]] + ops[i+1:]
+            else:
+                candidate = ops[:i] + ops[i+1:]
+            if same(candidate):
+                ops = candidate
+                if len(op) <= 4:
+                    removed = True
+                    break
+                continue
+            j += 2
+        if not removed:
+            i += 1
+    return ops
+
+def optimize(ops, profile=None):
+    # shrink the draw commands without changing a single pixel of the result.
+    # Returns the new ops and the bytes saved per pass.
+    profile = Profile() if profile == None else profile
+    target = rasterize(ops)
+    # images after each prefix of the accepted ops, so a candidate only has to be rendered from its first edited op on
+    base = list(ops)
+    prefixes = [raster.new_frame()]
+
+    def frame(n):
+        # the image after the first n accepted ops
+        while len(prefixes) <= n:
+            prefixes.append(rasterize(base[len(prefixes)-1:len(prefixes)], prefixes[-1]))
+        return prefixes[n]
+
+    def same(candidate):
+        nonlocal base, prefixes
+        # the edit replaces base[k:end] by candidate[k:len(candidate)-(len(base)-end)], the ops after it are the same
+        k = 0
+        while k < min(len(base), len(candidate)) and base[k] == candidate[k]:
+            k += 1
+        end = len(base)
+        while end > k and end - len(base) + len(candidate) > k and base[end-1] == candidate[end-1-len(base)+len(candidate)]:
+            end -= 1
+        edited = candidate[k:end-len(base)+len(candidate)]
+        profile.count("optimizer candidates")
+        after = rasterize(edited, frame(k))
+        if np.array_equal(after, frame(end)):
+            # the edited ops leave the same image, so everything after them draws the same as well
+            prefixes = prefixes[:k+1] + ([after] if len(edited) == 1 else []) + (prefixes[end+1:] if len(edited) <= 1 else [])
+        else:
+            # the ops after the edit might still cover the difference, only then they have to be drawn
+            if not np.array_equal(rasterize(candidate[k+len(edited):], after), target):
+                return False
+            del prefixes[k+1:]
+        profile.count("optimizer edits")
+        base = candidate
+        return True
+
+    saved = []
+    for name, run in (("merge polylines", merge_polylines), ("drop points", drop_points), ("merge fills", merge_fills), ("drop fills", drop_fills)):
+        size = len(encode(ops))
+        ops = run(ops, same)
+        saved.append((name, size - len(encode(ops))))
+    return ops, saved
+
+def region_graph(fb):
+    # the 4-connected regions of equal colour of a framebuffer and the regions each one touches
+    labels, count = label_regions(fb)
+    pairs = []
+    for a, b in ((labels[:, :-1], labels[:, 1:]), (labels[:-1], labels[1:])):
+        edge = a != b
+        pairs.append(a[edge].astype(np.int64) * count + b[edge])
+    adjacent = [set() for i in range(count)]
+    for a, b in zip(*(x.tolist() for x in np.divmod(np.unique(np.concatenate(pairs)), count))):
+        adjacent[a].add(b)
+        adjacent[b].add(a)
+    return labels, count, adjacent
+
+def fill_order(start, ops, target):
+    # Fewer fill seeds for a run of ops drawn on top of start that ends in target: its polylines are drawn first, and the regions they leave are then
+    # flooded in an order that ends in the same picture. Filling a region merges it with the touching regions of the new colour, and
+    # a merged region is always flooded as a whole, so the fills are simulated on the region adjacency graph of the outlines
+    # (a union-find with a histogram of the wanted colours per merged region) instead of on pixels.
+    # Returns the new ops, or None if there is no such order.
+    polys = [op for op in ops if op[0] == 0xFF]
+    outline = rasterize(polys, start)
+    labels, count, adjacent = region_graph(outline)
+    flat = labels.ravel()
+    # regions are numbered in the order they first appear
+    first = np.flatnonzero(np.diff(np.maximum.accumulate(flat), prepend=-1) > 0)
+    # every pixel of a region is flooded at once, so they all have to end up in the same colour
+    lo = np.full(count, 255, dtype=np.uint8)
+    hi = np.zeros(count, dtype=np.uint8)
+    np.minimum.at(lo, flat, target.ravel())
+    np.maximum.at(hi, flat, target.ravel())
+    if (lo != hi).any():
+        return None
+    # seeds can only be placed where the draw commands can reach
+    reachable = np.flatnonzero((np.arange(target.shape[0])[:, None] >= 40) & (np.arange(target.shape[1]) >= 70))
+    firsti = np.full(count, len(flat))
+    np.minimum.at(firsti, flat[reachable], reachable)
+    seed = [i if i < len(flat) else None for i in firsti.tolist()]
+
+    colour = outline.ravel()[first].tolist()
+    parent = list(range(count))
+    wanted = [{t: 1} for t in lo.tolist()]
+    near = [set(a) for a in adjacent]
+
+    def find(r):
+        while parent[r] != r:
+            parent[r] = parent[parent[r]]
+            r = parent[r]
+        return r
+
+    def flood(r, col):
+        colour[r] = col
+        for q in [find(n) for n in near[r]]:
+            q = find(q)
+            if q != r and colour[q] == col:
+                if len(near[r]) < len(near[q]):
+                    r, q = q, r
+                parent[q] = r
+                todo.discard(q)
+                near[r] |= near[q]
+                for t, n in wanted[q].items():
+                    wanted[r][t] = wanted[r].get(t, 0) + n
+                if seed[r] == None or (seed[q] != None and seed[q] < seed[r]):
+                    seed[r] = seed[q]
+        near[r] = {find(n) for n in near[r]} - {r}
+        if wanted[r].keys() == {col}:
+            todo.discard(r)
+        else:
+            todo.add(r)
+
+    def options(r):
+        # the fills that are safe to do in region r now, as (regions joined, fill with the wanted colour, -seed, region, colour)
+        if len(wanted[r]) != 1 or seed[r] == None:
+            return []
+        t = next(iter(wanted[r]))
+        near[r] = {find(n) for n in near[r]} - {r}
+        by_colour = {}
+        for q in near[r]:
+            by_colour.setdefault(colour[q], []).append(q)
+        result = []
+        # flooding with the wanted colour merges with the neighbours in that colour, they must not want anything else
+        if all(wanted[q].keys() == {t} for q in by_colour.get(t, [])):
+            result.append((1, True, -seed[r], r, t))
+        # flooding with a colour several neighbours have that want the same colour first joins them, they then take one seed instead of one each
+        for x, group in by_colour.items():
+            if x != t and len(group) >= 2 and all(wanted[q].keys() == {t} for q in group):
+                result.append((len(group), False, -seed[r], r, x))
+        return result
+
+    # The merged regions that don't have their final colour yet, and their options. A fill only changes the options of the
+    # flooded region and its neighbours, the others are kept. The choice is greedy: the fill joining the most regions first,
+    # preferring the colour of the previous fill, so the seeds are fewer but not necessarily the fewest possible.
+    todo = {r for r in range(count) if wanted[r].keys() != {colour[r]}}
+    opts = {}
+    dirty = set(todo)
+    fills = []
+    while len(todo) > 0:
+        for r in dirty:
+            if r in todo and find(r) == r:
+                opts[r] = options(r)
+            else:
+                opts.pop(r, None)
+        last = fills[-1][1] if fills else None
+        best = None
+        for result in opts.values():
+            for n, same_colour, s, r, col in result:
+                option = (n, same_colour and col == last, s, r, col)
+                best = option if best == None or option > best else best
+        if best == None:
+            return None
+        _, _, _, r, col = best
+        fills.append((seed[r], col))
+        flood(r, col)
+        r = find(r)
+        dirty = {r} | near[r] | (set(opts) - set(todo))
+
+    # consecutive seeds of the same colour share a header
+    new = list(polys)
+    for i, col in fills:
+        y, x = divmod(i, target.shape[1])
+        if len(new) > 0 and new[-1][0] == 0xFE and new[-1][1] == col:
+            new[-1] = new[-1] + [x - 70, y - 40]
+        else:
+            new.append([0xFE, col, x - 70, y - 40])
+    return new
+
+def solve_fills(ops, profile=None):
+    # Replace the fill seeds found shape by shape with fewer ones found for the whole image. Where outlines drawn later would join
+    # regions that have to be filled differently the fills can't all wait for the outlines, so the ops are split in halves until
+    # every part can be solved on its own, or has no fills left to move.
+    profile = Profile() if profile == None else profile
+
+    # the image after the first i ops, for the places the ops are split at
+    frames = {0: raster.new_frame(), len(ops): rasterize(ops)}
+
+    def frame(i):
+        if i not in frames:
+            j = max(k for k in frames if k < i)
+            frames[i] = rasterize(ops[j:i], frames[j])
+        return frames[i]
+
+    def solve(lo, hi):
+        part = ops[lo:hi]
+        # a single seed can't get any cheaper
+        if sum((len(op) - 2) // 2 for op in part if op[0] == 0xFE) < 2:
+            return part
+        new = fill_order(frame(lo), part, frame(hi))
+        if new != None:
+            return new if len(encode(new)) < len(encode(part)) else part
+        if len(part) < 2:
+            return part
+        half = (lo + hi) // 2
+        return solve(lo, half) + solve(half, hi)
+
+    target = frames[len(ops)]
+    new = solve(0, len(ops))
+    if len(encode(new)) >= len(encode(ops)) or not np.array_equal(rasterize(new), target):
+        return ops
+    seeds = lambda ops: sum((len(op) - 2) // 2 for op in ops if op[0] == 0xFE)
+    profile.count("fill seeds saved", seeds(ops) - seeds(new))
+    return new
+
+def block_cost(spans, h):
+    # a block is a 6 byte header followed by h rows of 16-bit words
+    return sum(6 + ((x1-x0+15)//16)*2*h for x0,x1 in spans)
+
+def column_spans(cols, h):
+    # split a band at empty columns where that is cheaper than one wide block.
+    # Returns the spans of the cheapest grouping of the non-empty column runs.
+    xs = np.flatnonzero(np.diff(np.concatenate(([0], cols.astype(np.int8), [0]))))
+    runs = list(zip(xs[0::2].tolist(), xs[1::2].tolist()))
+    best = [(0, [])]
+    for i in range(1, len(runs)+1):
+        best.append(min(((best[j][0] + block_cost([(runs[j][0], runs[i-1][1])], h), best[j][1] + [(runs[j][0], runs[i-1][1])]) for j in range(i)), key=lambda c: c[0]))
+    return best[-1]
+
+def bitmap_layout(mask):
+    # cheapest split of a 1-bit mask into blocks: the rows are cut into bands, and each band is split at empty columns.
+    # Returns a list of (x0, y0, x1, y1) rectangles.
+    h = mask.shape[0]
+    rows = mask.any(axis=1)
+    counts = np.concatenate((np.zeros((1, mask.shape[1]), dtype=np.int32), np.cumsum(mask, axis=0, dtype=np.int32)))
+    best = [(0, [])]
+    for i in range(1, h+1):
+        if not rows[i-1]:
+            best.append(best[i-1])
+            continue
+        choice = None
+        for j in range(i):
+            if j > 0 and not rows[j-1]:
+                # same band as starting one row earlier
+                continue
+            nz = np.flatnonzero(rows[j:i])
+            y0, y1 = j + nz[0], j + nz[-1] + 1
+            cost, spans = column_spans(counts[i] - counts[j] > 0, y1 - y0)
+            cost += best[j][0]
+            if choice == None or cost < choice[0]:
+                choice = (cost, best[j][1] + [(x0, y0, x1, y1) for x0, x1 in spans])
+        best.append(choice)
+    return best[-1][1]
+
+def encode_bitmaps(pens):
+    # pack a pen index array (0 = not drawn) into the >hBBBB block list read by kick2svg.decode_bitmaps
+    images = []
+    for pen in range(1, 4):
+        mask = pens == pen
+        for x0, y0, x1, y1 in bitmap_layout(mask):
+            w = (x1-x0+15)//16
+            block = np.zeros((y1-y0, w*16), dtype=bool)
+            block[:, :x1-x0] = mask[y0:y1, x0:x1]
+            images.extend(struct.pack(">hBBBB", pen, w, y1-y0, x0, y0))
+            images.extend(np.packbits(block, axis=1).tobytes())
+    images.extend([255,255])
+    return images
+
+class Profile:
+    # time spent per stage and event counters of a conversion, reported with --profile.
+    # Stages can nest, "fill search" is part of "render".
+    def __init__(self):
+        self.times = {}
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] = self.times.get(name, 0) + time.perf_counter() - start
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        return {"stages": self.times, "counters": self.counters}
 
 class Convert:
     def __init__(self):
-        # we render the temporary image to RGBA
-        self.im = Image.new("RGB", (320, 200), color=(255,255,255))
-        self.draw = ImageDraw.Draw(self.im)
+        self.profile = Profile()
+        # we render the temporary image the way the Kickstart draws it, with indices into self.colours as pens
+        self.fb = raster.new_frame()
+        self.colours = [(255,255,255)]
         self.strokeColor = (0,0,0)
         self.fillColor = None
         self.ops = []
         self.bitmaps = []
+        # (encoded ops, solved and optimized ops and savings) of the last conversion, watch mode hands it to the next one
+        self.optimized = None
+        # whether images may be loaded from files and URLs, otherwise only data: URIs are read
+        self.remote = True
+
+    def pen(self, col):
+        if col not in self.colours:
+            self.colours.append(col)
+        return self.colours.index(col)
 
     def line(self, p):
         x1,y1,x2,y2 = p
-        self.draw.line((x1, y1, x2, y2) , fill=self.strokeColor)
+        raster.draw_line(self.fb, *snap((x1, y1)), *snap((x2, y2)), self.pen(self.strokeColor))
         draw = [0xFF, self.strokeColor]
         draw.extend(project((x1, y1)))
         draw.extend(project((x2, y2)))
-        self.op.append(draw)
+        self.ops.append(draw)
 
-    def rect(self, p):
+    def rect(self, p, m=IDENTITY):
         x,y,w,h = p
-        self.poly([(x,y), (x+w,y), (x+w,y+h), (x,y+h), (x,y)])
+        self.poly([round_vec(transform_point(m, q)) for q in ((x,y), (x+w,y), (x+w,y+h), (x,y+h), (x,y))])
 
     def poly(self, p):
+        q = [snap(point) for point in p]
         if self.fillColor != None:
-            self.draw.polygon(p, outline=self.fillColor)
+            fill = self.pen(self.fillColor)
+            raster.draw_polyline(self.fb, q, fill)
 
             draw = [0xFF, self.fillColor]
             for point in p:
                 draw.extend(project(point))
             self.ops.append(draw)
 
-            imCopy = self.im.copy()
-            imDraw = ImageDraw.Draw(imCopy)
-            imDraw.polygon(p, fill=self.fillColor)
-            width = self.im.width
-            height = self.im.height
-            for y in range(height):
-                for x in range(width):
-                    if self.im.getpixel((x,y)) != imCopy.getpixel((x,y)):
-                        # ImageDraw.polygon may fill outside the boundary, so we need to test if the fill leaks
-                        imTest = self.im.copy()
-                        ImageDraw.floodfill(imTest, (x,y), self.fillColor)
-                        valid = True
-                        for ty in range(height):
-                            for tx in range(width):
-                                testPixel = imTest.getpixel((tx,ty))
-                                copyPixel = imCopy.getpixel((tx,ty))
-                                if testPixel != copyPixel and testPixel == self.fillColor:
-                                    valid = False
-                                    break
-                        if valid:
-                            ImageDraw.floodfill(self.im, (x,y), self.fillColor)
-                            draw = [0xFE, self.fillColor]
-                            draw.extend(project((x,y)))
-                            self.ops.append(draw)
+            from PIL import Image, ImageDraw
+            mask = Image.new("1", (self.fb.shape[1], self.fb.shape[0]))
+            ImageDraw.Draw(mask).polygon(q, fill=1, outline=1)
+
+            # The outline may not enclose the same area as the polygon, so a flood fill is only usable if the whole region it floods ends up filled.
+            # Every region is flooded as a unit, so one seed per region is enough.
+            with self.profile.stage("fill search"):
+                covered = (self.fb == fill) | np.asarray(mask)
+                labels, count = label_regions(self.fb)
+                leaks = np.bincount(labels.ravel(), weights=~covered.ravel(), minlength=count)
+                wanted = np.bincount(labels.ravel(), weights=(covered & (self.fb != fill)).ravel(), minlength=count)
+                _, seeds = np.unique(labels.ravel(), return_index=True)
+                self.profile.count("pixels scanned", self.fb.size)
+                self.profile.count("fills tried", int(np.count_nonzero(wanted > 0)))
+                self.profile.count("fills rejected", int(np.count_nonzero((wanted > 0) & (leaks > 0))))
+                for seed in sorted(seeds[(wanted > 0) & (leaks == 0)]):
+                    y, x = divmod(int(seed), self.fb.shape[1])
+                    raster.flood_fill(self.fb, x, y, fill)
+                    draw = [0xFE, self.fillColor]
+                    draw.extend(project((x,y)))
+                    self.ops.append(draw)
 
         if self.strokeColor != None and self.strokeColor != self.fillColor:
-            for i in range(len(p)-1):
-                self.draw.line(p[i] + p[i+1], fill=self.strokeColor)
-            # self.draw.polygon(p, outline=self.strokeColor)
+            raster.draw_polyline(self.fb, q, self.pen(self.strokeColor))
 
             draw = [0xFF, self.strokeColor]
             for point in p:
@@ -148,118 +849,55 @@ class Convert:
         self.stroke(e.get("stroke", ""))
         self.fill(e.get("fill", ""))
 
-    def render(self, cmd, ofs):
-        if cmd.tag == "{http://www.w3.org/2000/svg}g":
-            backup_ofs = self.ofs
-            transform = cmd.get("transform", "")
-            # good enough:
-            m = re.match(".*translate.*\(([0-9]+),([0-9]+)\)", transform)
-            if m:
-                self.ofs = (self.ofs[0] + float(m.group(1)), self.ofs[1] + float(m.group(2)))
-            for x in cmd:
-                self.render(x, ofs)
-            self.ofs = backup_ofs
-        elif cmd.tag == "{http://www.w3.org/2000/svg}polygon":
-            self.get_style(cmd)
-            points = " ".join(cmd.get("points", "").split(",")).split(" ")
-            p = []
-            for i in range(len(points)//2):
-                p.append(round_vec(float(points[i*2]), float(points[i*2+1])))
-            self.poly(p + [p[0]])
-        elif cmd.tag == "{http://www.w3.org/2000/svg}polyline":
-            self.get_style(cmd)
-            points = " ".join(cmd.get("points", "").split(",")).split(" ")
-            p = []
-            for i in range(len(points)//2):
-                p.append(round_vec(float(points[i*2]), float(points[i*2+1])))
-            self.poly(p)
-        elif cmd.tag == "{http://www.w3.org/2000/svg}rect":
-            self.get_style(cmd)
-            pos = round_vec((float(cmd.get("x","0")), float(cmd.get("y", "0"))))
-            size = round_vec((float(cmd.get("width","0")), float(cmd.get("height", "0"))))
-            self.rect(pos+size)
-        elif cmd.tag == "{http://www.w3.org/2000/svg}path":
-            self.get_style(cmd)
-            d = " ".join(cmd.get("d", "").split(",")).split(" ")
-            pos = (0,0)
-            start = pos
-            ofs = 0
-            poly = []
-            while ofs < len(d):
-                op = d[ofs] 
-                absolute = op.isupper()
-                ofs += 1
-                if op.lower() == "m":
-                    pos = add_cond(absolute, tuple([float(x) for x in d[ofs:ofs+2]]), pos)
-                    ofs += 2
-                    start = pos
-                    poly = [round_vec(pos)]
-                    while ofs < len(d) and not d[ofs].isalpha():
-                        p2 = add_cond(absolute, tuple([float(x) for x in d[ofs:ofs+2]]), pos)
-                        ofs += 2
-                        poly.append(round_vec(p2))
-                        pos = p2
-                elif op.lower() == "l":
-                    while ofs < len(d) and not d[ofs].isalpha():
-                        p2 = add_cond(absolute, tuple([float(x) for x in d[ofs:ofs+2]]), pos)
-                        ofs += 2
-                        poly.append(round_vec(p2))
-                        pos = p2
-                elif op.lower() == "h":
-                    while ofs < len(d) and not d[ofs].isalpha():
-                        if absolute:
-                            p2 = float(d[ofs]),pos[1]
-                        else:
-                            p2 = float(d[ofs])+pos[0],pos[1]
-                        ofs += 1
-                        poly.append(round_vec(p2))
-                        pos = p2
-                elif op.lower() == "v":
-                    while ofs < len(d) and not d[ofs].isalpha():
-                        if absolute:
-                            p2 = pos[0],float(d[ofs])
-                        else:
-                            p2 = pos[0],float(d[ofs])+pos[1]
-                        ofs += 1
-                        poly.append(round_vec(p2))
-                        pos = p2
-                elif op.lower() == 'z':
-                    poly.append(round_vec(start))
+    def render(self, tag, e, m=IDENTITY):
+        # draw one primitive from primitives(), e are its attributes and m its transform
+        if tag == "line":
+            self.get_style(e)
+            p = [round_vec(transform_point(m, (float(e.get("x%i" % i, "0")), float(e.get("y%i" % i, "0"))))) for i in (1, 2)]
+            if self.strokeColor != None:
+                self.line(p[0] + p[1])
+        elif tag == "polygon" or tag == "polyline":
+            self.get_style(e)
+            coords = [float(v) for v in PATH_NUM.findall(e.get("points", ""))]
+            p = [round_vec(transform_point(m, (coords[i], coords[i+1]))) for i in range(0, len(coords)-1, 2)]
+            if len(p) > 1:
+                self.poly(p + [p[0]] if tag == "polygon" else p)
+        elif tag == "rect":
+            self.get_style(e)
+            self.rect((float(e.get("x","0")), float(e.get("y", "0")), float(e.get("width","0")), float(e.get("height", "0"))), m)
+        elif tag == "path":
+            self.get_style(e)
+            # flatten finely enough that the curve is still within half a pixel after scaling
+            scale = math.sqrt(abs(m[0]*m[3] - m[1]*m[2]))
+            for points in flatten_path(e.get("d", ""), 0.5 / scale if scale > 1 else 0.5):
+                poly = [round_vec(transform_point(m, points[0]))]
+                for p in points[1:]:
+                    p = round_vec(transform_point(m, p))
+                    if p != poly[-1]:
+                        poly.append(p)
+                if len(poly) > 1:
                     self.poly(poly)
-                    poly = []
-                    pos = start
-                elif op.lower() == 'c':
-                    # this is a curve, but we're just drawing a line - if you need to approximate a curve you need to manually turn it into line segments
-                    while ofs < len(d) and not d[ofs].isalpha():
-                        p2 = add_cond(absolute, tuple([float(x) for x in d[ofs+4:ofs+6]]), pos)
-                        ofs += 6
-                        poly.append(round_vec(p2))
-                        pos = p2
-                elif op.lower() == 's':
-                    # this is a curve, but we're just drawing a line - if you need to approximate a curve you need to manually turn it into line segments
-                    while ofs < len(d) and not d[ofs].isalpha():
-                        p2 = add_cond(absolute, tuple([float(x) for x in d[ofs+2:ofs+4]]), pos)
-                        ofs += 4
-                        poly.append(round_vec(p2))
-                        pos = p2
-                else:
-                    print ("unknown op %s" % op)
-            if len(poly) > 0:
-                self.poly(poly)
-        elif cmd.tag == "{http://www.w3.org/2000/svg}circle":
-            self.get_style(cmd)
-            pos = round_vec((float(cmd.get("cx", 0)), float(cmd.get("cy", 0))))
-
-            ImageDraw.floodfill(self.im, pos, self.fillColor)
+        elif tag == "circle":
+            self.get_style(e)
+            pos = round_vec(transform_point(m, (float(e.get("cx", 0)), float(e.get("cy", 0)))))
+
+            raster.flood_fill(self.fb, *snap(pos), self.pen(self.fillColor))
             draw = [0xFE, self.fillColor]
             draw.extend(project(pos))
             self.ops.append(draw)
-        elif cmd.tag == "{http://www.w3.org/2000/svg}image":
-            pos = round_vec((float(cmd.get("x","0")), float(cmd.get("y", "0"))))
-            size = round_vec((float(cmd.get("width","0")), float(cmd.get("height", "0"))))
-            data_uri = cmd.get("{http://www.w3.org/1999/xlink}href", "")
+        elif tag == "image":
+            # bitmaps can't be rotated or skewed, only the position and size of the transformed bounding box are used
+            x, y, w, h = float(e.get("x","0")), float(e.get("y", "0")), float(e.get("width","0")), float(e.get("height", "0"))
+            (x0, y0), (x1, y1) = transform_point(m, (x, y)), transform_point(m, (x+w, y+h))
+            pos = round_vec((min(x0, x1), min(y0, y1)))
+            size = round_vec((abs(x1 - x0), abs(y1 - y0)))
+            data_uri = e.get("{http://www.w3.org/1999/xlink}href", "")
 
-            if len(data_uri) > 0:
+            if len(data_uri) > 0 and size[0] > 0 and size[1] > 0:
+                if not self.remote and not data_uri.startswith("data:"):
+                    raise ValueError("only data: URIs are allowed for images")
+                from PIL import Image
+                from urllib.request import urlopen
                 with urlopen(data_uri) as response:
                     image_data = response.read()
                 image = Image.open(io.BytesIO(image_data))
@@ -267,86 +905,416 @@ class Convert:
                     image = image.resize(size, Image.Resampling.NEAREST)
                 self.bitmaps.append((pos, image))
 
-        else:
-            print (cmd.tag)
-
-    def process(self, path):
-        self.ofs = (0,0)
-        svg = ET.parse(path).getroot()
-        for cmd in svg:
-            self.render(cmd, (0,0))
-        im = self.im.convert("P", colors=4, dither=Image.Dither.NONE)
-        pal = im.getpalette()
-        used_cols = [(pal[x*3+0],pal[x*3+1],pal[x*3+2]) for x in set(im.getdata())]
-        remap = {}
-        self.out_pal = []
-        bg_col = remap_col(remap, self.im.getpixel((0,0)), used_cols, self.out_pal)
-        self.vectors = []
-        for op in self.ops:
-            self.vectors.extend([op[0], remap_col(remap, op[1], used_cols, self.out_pal)])
-            self.vectors.extend(op[2:])
-        self.vectors.extend([255,255])
-
-        self.images=[]
-        self.images.extend([255,255])
+    def composite(self):
+        # bitmaps are drawn after the vectors, so paste them over the rendered image to get the final picture.
+        # Also returns which pixels the bitmaps cover.
+        screen = np.array(self.colours, dtype=np.uint8)[self.fb]
+        covered = np.zeros(screen.shape[:2], dtype=bool)
+        for (x,y), image in self.bitmaps:
+            rgba = np.asarray(image.convert("RGBA"))
+            x0, y0 = max(x, 0), max(y, 0)
+            x1, y1 = min(x + image.width, screen.shape[1]), min(y + image.height, screen.shape[0])
+            if x0 >= x1 or y0 >= y1:
+                continue
+            src = rgba[y0-y:y1-y, x0-x:x1-x]
+            opaque = src[:,:,3] >= 128
+            screen[y0:y1, x0:x1][opaque] = src[:,:,:3][opaque] & 0xF0
+            covered[y0:y1, x0:x1] |= opaque
+        return screen, covered
+
+    def state(self):
+        # everything rendering an element changes, to go back to it in watch mode
+        return self.fb.copy(), list(self.colours), list(self.ops), list(self.bitmaps), self.strokeColor, self.fillColor
+
+    def restore(self, state):
+        fb, colours, ops, bitmaps, self.strokeColor, self.fillColor = state
+        self.fb, self.colours, self.ops, self.bitmaps = fb.copy(), list(colours), list(ops), list(bitmaps)
+
+    def process(self, path, optimize_ops=True, use_cache=False):
+        if use_cache:
+            # the same SVG was converted before, skip straight to patching
+            with self.profile.stage("hash"):
+                key = cache.key(path, optimize_ops)
+            entry = cache.get(key)
+            if entry != None:
+                self.profile.count("cache hits")
+                self.set_result(entry)
+                return
+        with self.profile.stage("render"):
+            for top, tag, e, m in primitives(path):
+                self.render(tag, e, m)
+        self.finish(optimize_ops)
+        if use_cache:
+            cache.put(key, self.result())
+
+    def result(self):
+        # what patching needs from a conversion, as JSON for the cache
+        return {"vectors":bytes(self.vectors).hex(), "images":bytes(self.images).hex(), "palette":self.out_pal, "saved":self.saved, "warnings":self.warnings}
 
+    def set_result(self, entry):
+        self.vectors = list(bytes.fromhex(entry["vectors"]))
+        self.images = list(bytes.fromhex(entry["images"]))
+        self.out_pal = [tuple(col) for col in entry["palette"]]
+        self.saved = [tuple(saved) for saved in entry["saved"]]
+        self.warnings = entry["warnings"]
+        self.model = kick2svg.decode_vectors(bytes(self.vectors))
+
+    def finish(self, optimize_ops=True):
+        # turn the rendered elements into the vector, image and palette data
+        with self.profile.stage("quantize"):
+            screen, covered = self.composite()
+            # pen 0 is the colour the screen is cleared to
+            keys = ocs_keys(screen)
+            palette, lut = quantize(keys, int(ocs_keys(self.colours[0])), [int(ocs_keys(op[1])) for op in self.ops])
+            self.out_pal = [ocs_rgb(col) for col in palette]
+            ops = [[op[0], int(lut[ocs_keys(op[1])])] + op[2:] for op in self.ops]
+        self.saved = []
+        if optimize_ops:
+            # the fill solver and the optimizer only depend on the ops, an unchanged logo reuses their result
+            key = bytes(encode(ops))
+            if self.optimized == None or self.optimized[0] != key:
+                with self.profile.stage("fill solver"):
+                    solved = solve_fills(ops, self.profile)
+                    saved = [("solve fills", len(key) - len(encode(solved)))]
+                with self.profile.stage("optimize"):
+                    solved, more = optimize(solved, self.profile)
+                self.optimized = (key, (solved, saved + more))
+            ops, saved = self.optimized[1]
+            self.saved.extend(saved)
+        self.vectors = encode(ops)
+        # the same model kick2svg decodes from a ROM, to compare conversions against each other or against a ROM
+        self.model = kick2svg.decode_vectors(bytes(self.vectors))
+        self.profile.count("ops emitted", len(self.model))
+
+        # only the bitmap pixels that differ from what the vectors already drew have to be stored, pixels in the background colour are left out.
+        # Pen 0 is transparent in a bitmap block, so background pixels on top of something the vectors drew are lost.
+        with self.profile.stage("bitmaps"):
+            pens = np.zeros(covered.shape, dtype=np.uint8)
+            lost = 0
+            if covered.any():
+                pens[covered] = lut[keys[covered]]
+                drawn = rasterize(ops)
+                lost = int(np.count_nonzero(covered & (pens == 0) & (drawn != 0)))
+                pens[drawn == pens] = 0
+            self.images = encode_bitmaps(pens[40:, 70:])
+        self.profile.count("bitmap pixels lost", lost)
+        self.profile.count("vector bytes", len(self.vectors))
+        self.profile.count("image bytes", len(self.images))
+        self.profile.count("palette bytes", len(self.out_pal) * 2)
+
+        self.warnings = []
         if len(self.vectors) > 412:
-            print("warning: Vector data too large, %i > 412 byte" % len(self.vectors))
+            self.warnings.append("Vector data too large, %i > 412 byte" % len(self.vectors))
         # print (vectors, len(vectors))
         if len(self.images) > 310:
-            print("warning: Image data too large, %i > 310 byte" % len(self.images))
+            self.warnings.append("Image data too large, %i > 310 byte" % len(self.images))
+        if lost > 0:
+            self.warnings.append("%i bitmap pixels in the background colour cover vector drawn pixels and can't be stored" % lost)
         # print (images, len(images))
 
-    def patch(self, path):
-        # load original kickstart
-        with open(path, "rb") as f:
-            self.data = bytearray(f.read())
-
-        # patch draw instructions:
-        for i in range(len(self.vectors)):
-            self.data[i+0x289d0] = self.vectors[i]
-        for i in range(len(self.images)):
-            self.data[i+0x28B6C] = self.images[i]
-
-        # patch palette
-        for i in range(len(self.out_pal)):
-            col = self.out_pal[i]
-            col = (col[0] >> 4) << 8 | (col[1] >> 4) << 4 | (col[2] >> 4)
-            # print ("%4.4x" % col)
-            struct.pack_into(">H", self.data, 0x2872A + i * 2, col)
-
-        # patch checksum (not really required for ROMs, but silences the checksum warning in UAE.)
-        struct.pack_into(">I", self.data, len(self.data) - 24, 0)
-        checksum = 0
-        for i in range(len(self.data)//4):
-            val, = struct.unpack_from(">I", self.data, i*4)
-            checksum += val
-            # checksum is calculated with carry, so if we overflow we wrap around and add the carry
-            if checksum > 0xFFFFFFFF:
-                checksum -= 0xFFFFFFFF
-        if checksum != 0xFFFFFFFF:
-            struct.pack_into(">I", self.data, len(self.data) - 24,  0xFFFFFFFF - checksum)
+    def write(self, ofs, values):
+        # write into the ROM image and keep track of how much the sum of the touched words changed
+        start, end = ofs & ~3, (ofs + len(values) + 3) & ~3
+        before = word_sum(self.data[start:end])
+        self.data[ofs:ofs+len(values)] = bytes(values)
+        self.delta += word_sum(self.data[start:end]) - before
+
+    def patch(self, path, checksum="incremental", in_place=False):
+        # map the original kickstart, only the pages the logo is in are copied, or written back to the file in place
+        data = rom.open_rom(path, "w" if in_place else "c")
+        self.apply(data, checksum)
+        if in_place:
+            if self.layout["swapped"]:
+                data[:] = rom.swap(self.data)
+            data.flush()
+
+    def patch_data(self, data, checksum="incremental"):
+        # patch a copy of an already loaded kickstart image
+        self.apply(bytearray(data), checksum)
+
+    def apply(self, data, checksum):
+        # patch a writable kickstart image
+        with self.profile.stage("locate"):
+            self.layout = rom.lookup(data)
+            self.data = bytearray(rom.swap(data)) if self.layout["swapped"] else data
+        size = self.layout["size"]
+
+        for base in self.layout["copies"]:
+            self.delta = 0
+
+            with self.profile.stage("patch"):
+                # patch draw instructions:
+                self.write(base + self.layout["vectors"], self.vectors)
+                self.write(base + self.layout["images"], self.images)
+
+                # patch palette
+                for i in range(len(self.out_pal)):
+                    col = self.out_pal[i]
+                    col = (col[0] >> 4) << 8 | (col[1] >> 4) << 4 | (col[2] >> 4)
+                    # print ("%4.4x" % col)
+                    self.write(base + self.layout["palette"] + i * 2, struct.pack(">H", col))
+
+            # patch checksum (not really required for ROMs, but silences the checksum warning in UAE.)
+            with self.profile.stage("checksum"):
+                ofs = base + size - 24
+                if checksum == "incremental":
+                    # only a few hundred bytes change, so adjust the old checksum by the difference instead of summing the whole ROM.
+                    # This assumes the original checksum was valid, use verify() or the full mode if that isn't guaranteed.
+                    old, = struct.unpack_from(">I", self.data, ofs)
+                    struct.pack_into(">I", self.data, ofs, (old - self.delta) % 0xFFFFFFFF)
+                else:
+                    struct.pack_into(">I", self.data, ofs, 0)
+                    struct.pack_into(">I", self.data, ofs, 0xFFFFFFFF - rom_checksum(memoryview(self.data)[base:base+size]))
+
+    def output(self):
+        # the patched kickstart in the byte order of the original
+        return rom.swap(self.data) if self.layout["swapped"] else self.data
 
     def save(self, path):
         # write patched kickstart
-        with open(path, "wb") as f:
-            f.write(self.data)
+        rom.write_atomic(path, self.output())
+
+class Watch:
+    # Keeps the ROM and the conversion resident and patches again whenever the SVG is saved.
+    # Fills depend on what was drawn before them, so the state after every top level element is kept, and after a change
+    # only the elements from the first changed one onward are rendered again. The draw commands are written as rendered if
+    # they fit, and shrunk and written again once the file has stayed the same for a moment.
+    def __init__(self, kick, svg, out, checksum="incremental", optimize_ops=True):
+        self.svg = svg
+        self.out = out
+        self.checksum = checksum
+        self.optimize_ops = optimize_ops
+        with open(kick, "rb") as f:
+            self.data = f.read()
+        self.start = Convert().state()
+        # (hash of the element, state after rendering it) per top level element
+        self.states = []
+        self.optimized = None
+        # conversion written without shrinking the draw commands
+        self.pending = None
+        self.stamp = None
+
+    def changed(self):
+        try:
+            st = os.stat(self.svg)
+        except OSError:
+            return False
+        stamp = (st.st_mtime_ns, st.st_size)
+        if stamp == self.stamp:
+            return False
+        self.stamp = stamp
+        return True
+
+    def update(self):
+        # convert and patch, returns the converter and the number of elements rendered
+        elements = []
+        for top, tag, e, m in primitives(self.svg):
+            while len(elements) <= top:
+                elements.append((hashlib.sha1(), []))
+            elements[top][0].update(repr((tag, sorted(e.items()), m)).encode("utf-8"))
+            elements[top][1].append((tag, e, m))
+        hashes = [h.digest() for h, prims in elements]
+        keep = 0
+        while keep < min(len(hashes), len(self.states)) and self.states[keep][0] == hashes[keep]:
+            keep += 1
+        del self.states[keep:]
+
+        convert = Convert()
+        convert.optimized = self.optimized
+        convert.restore(self.states[-1][1] if keep > 0 else self.start)
+        for key, (h, prims) in zip(hashes[keep:], elements[keep:]):
+            for tag, e, m in prims:
+                convert.render(tag, e, m)
+            self.states.append((key, convert.state()))
+        convert.finish(False)
+        self.pending = None
+        if self.optimize_ops:
+            if len(convert.vectors) <= 412:
+                self.pending = convert
+            else:
+                convert.finish(True)
+                self.optimized = convert.optimized
+        convert.patch_data(self.data, self.checksum)
+        convert.save(self.out)
+        return convert, len(hashes) - keep
+
+    def optimize(self):
+        # shrink the draw commands of the last conversion and patch again
+        convert, self.pending = self.pending, None
+        convert.finish(True)
+        self.optimized = convert.optimized
+        convert.patch_data(self.data, self.checksum)
+        convert.save(self.out)
+        return convert
+
+    def run(self, interval=0.2):
+        while True:
+            if self.changed():
+                start = time.perf_counter()
+                try:
+                    convert, rendered = self.update()
+                except (ET.ParseError, ValueError, OSError) as e:
+                    # most likely caught the file half written, the next save will trigger again
+                    print("%s: %s" % (self.svg, e))
+                else:
+                    print("%s: rendered %i of %i elements, vector data: %i of 412 byte, image data: %i of 310 byte, written to %s in %.0f ms" % (self.svg, rendered, len(self.states), len(convert.vectors), len(convert.images), self.out, (time.perf_counter() - start) * 1000))
+                    for warning in convert.warnings:
+                        print("warning: %s" % warning)
+            elif self.pending != None:
+                # nothing was saved since the last patch
+                start = time.perf_counter()
+                convert = self.optimize()
+                print("%s: shrunk the draw commands, vector data: %i of 412 byte, written to %s in %.0f ms" % (self.svg, len(convert.vectors), self.out, (time.perf_counter() - start) * 1000))
+                continue
+            time.sleep(interval)
+
+# batch mode: every worker process keeps the ROMs and converted SVGs it has seen, so a ROM is read once per worker and only copied for each patch.
+
+@functools.lru_cache(maxsize=64)
+def load_rom(path):
+    return rom.open_rom(path)
+
+@functools.lru_cache(maxsize=64)
+def load_svg(path, optimize_ops=True, use_cache=False):
+    convert = Convert()
+    convert.process(path, optimize_ops, use_cache)
+    return convert
+
+def batch_job(job):
+    kick, svg, out, checksum, optimize_ops, use_cache = job
+    result = {"kick":kick, "svg":svg, "out":out}
+    try:
+        convert = load_svg(svg, optimize_ops, use_cache)
+        convert.patch_data(load_rom(kick), checksum)
+        convert.save(out)
+        result.update(vectors=len(convert.vectors), images=len(convert.images), saved=convert.saved, warnings=convert.warnings)
+    except Exception as e:
+        result["error"] = "%s: %s" % (type(e).__name__, e)
+    return result
+
+def read_manifest(path, out_dir):
+    # each line holds "kickstart svg [output]", kickstart and svg may be glob patterns which are combined pairwise
+    jobs = []
+    with open(path, "r") as f:
+        for line in f:
+            fields = line.split("#")[0].split()
+            if len(fields) == 0:
+                continue
+            kicks = sorted(glob.glob(fields[0])) or [fields[0]]
+            svgs = sorted(glob.glob(fields[1])) or [fields[1]]
+            for svg in svgs:
+                for kick in kicks:
+                    if len(fields) > 2 and len(kicks) == 1 and len(svgs) == 1:
+                        out = fields[2]
+                    else:
+                        name = "%s-%s.bin" % (os.path.splitext(os.path.basename(svg))[0], os.path.splitext(os.path.basename(kick))[0])
+                        out = os.path.join(out_dir, name)
+                    jobs.append((kick, svg, out))
+    return jobs
+
+def batch(jobs, checksum="incremental", workers=None, optimize_ops=True, use_cache=False):
+    # run (kickstart, svg, output) jobs on a process pool, results come back in job order.
+    # Jobs are sorted by SVG so a worker is likely to reuse the conversion it just did.
+    order = sorted(range(len(jobs)), key=lambda i: (jobs[i][1], jobs[i][0]))
+    results = [None] * len(jobs)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        chunksize = max(1, len(jobs) // (4 * (workers or os.cpu_count() or 1)))
+        for i, result in zip(order, pool.map(batch_job, [tuple(jobs[i]) + (checksum, optimize_ops, use_cache) for i in order], chunksize=chunksize)):
+            results[i] = result
+    return results
 
 def main():
     parser = argparse.ArgumentParser(description='Patch a new Amiga boot logo into the Kickstart 1.3 ROM')
-    parser.add_argument('kick', type=str, help='Kickstart ROM image')
-    parser.add_argument('svg',  type=str, help='SVG file')
-    parser.add_argument('--out', type=str, help='patched ROM image')
+    parser.add_argument('kick', type=str, nargs='?', help='Kickstart ROM image')
+    parser.add_argument('svg',  type=str, nargs='?', help='SVG file')
+    parser.add_argument('--out', type=str, help='patched ROM image (output directory in batch mode)')
+    parser.add_argument('--checksum', choices=['incremental', 'full'], default='incremental', help='update the ROM checksum from the changed words only, or recompute it over the whole ROM')
+    parser.add_argument('--verify', action='store_true', help='verify the checksum of the ROM image (and of the patched image if an SVG is given)')
+
+    parser.add_argument('--in-place', action='store_true', help='patch the ROM image itself, only the changed pages are written')
+    parser.add_argument('--no-optimize', action='store_true', help='write the draw commands as they are rendered, without shrinking them')
+    parser.add_argument('--batch', type=str, help='manifest with one "kickstart svg [output]" job per line, glob patterns are expanded')
+    parser.add_argument('--jobs', type=int, help='number of worker processes in batch mode (default: all cores)')
+    parser.add_argument('--no-cache', action='store_true', help='always convert the SVG, even if the same file was converted before')
+    parser.add_argument('--watch', action='store_true', help='keep running and patch again every time the SVG file changes')
+    parser.add_argument('--profile', type=str, help='write the time per stage and the conversion counters as JSON to this file ("-" for stdout)')
+    parser.add_argument('--cprofile', type=str, help='run the conversion under cProfile and dump the statistics to this file')
 
     args = parser.parse_args()
+    if args.in_place and args.out != None:
+        parser.error("--in-place and --out can't be used together")
 
-    convert = Convert()
-    convert.process(args.svg)
-    convert.patch(args.kick)
-    if args.out != None:
-        convert.save(args.out)
-    else:
-        convert.save("kick-patched.bin")
+    if args.batch != None:
+        out_dir = args.out if args.out != None else "."
+        os.makedirs(out_dir, exist_ok=True)
+        ok = True
+        for result in batch(read_manifest(args.batch, out_dir), args.checksum, args.jobs, not args.no_optimize, not args.no_cache):
+            if "error" in result:
+                print("%s + %s: error: %s" % (result["svg"], result["kick"], result["error"]))
+                ok = False
+                continue
+            print("%s + %s -> %s (%i vector bytes, %i image bytes, %i byte saved)" % (result["svg"], result["kick"], result["out"], result["vectors"], result["images"], sum(saved for name, saved in result["saved"])))
+            for warning in result["warnings"]:
+                print("  warning: %s" % warning)
+        if not ok:
+            sys.exit(1)
+        return
+    if args.kick == None:
+        parser.error("a Kickstart ROM image is required")
+
+    if args.watch:
+        if args.svg == None or args.in_place:
+            parser.error("--watch needs an SVG file and can't be used with --in-place")
+        try:
+            Watch(args.kick, args.svg, args.out if args.out != None else "kick-patched.bin", args.checksum, not args.no_optimize).run()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    ok = True
+    if args.verify:
+        with open(args.kick, "rb") as f:
+            if not verify(f.read()):
+                print("%s: checksum mismatch" % args.kick)
+                ok = False
+
+    if args.svg != None:
+        convert = Convert()
+        profiler = cProfile.Profile() if args.cprofile != None else None
+        if profiler != None:
+            profiler.enable()
+        convert.process(args.svg, not args.no_optimize, not args.no_cache)
+        for name, saved in convert.saved:
+            print("%s: saved %i byte" % (name, saved))
+        print("vector data: %i of 412 byte, image data: %i of 310 byte" % (len(convert.vectors), len(convert.images)))
+        for warning in convert.warnings:
+            print("warning: %s" % warning)
+        convert.patch(args.kick, args.checksum, args.in_place)
+        if args.verify and not verify(convert.data):
+            print("patched image: checksum mismatch")
+            ok = False
+        with convert.profile.stage("save"):
+            if args.in_place:
+                pass
+            elif args.out != None:
+                convert.save(args.out)
+            else:
+                convert.save("kick-patched.bin")
+        if profiler != None:
+            profiler.disable()
+            profiler.dump_stats(args.cprofile)
+        if args.profile != None:
+            report = json.dumps(convert.profile.report(), indent=1, sort_keys=True)
+            if args.profile == "-":
+                print(report)
+            else:
+                with open(args.profile, "w") as f:
+                    f.write(report)
+    elif not args.verify:
+        parser.error("an SVG file is required unless --verify is given")
+
+    if not ok:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()